@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+# band_stats.py
+# --------------------
+# Per-band pixel statistics of the training set, for normalizing the model
+# inputs. One streaming pass over the part-* shards, spread over worker
+# processes, builds a 256-bin histogram of every band for every class; the
+# per-shard histograms are merged by adding them, and the per-band mean,
+# standard deviation, min/max and percentiles are exact functions of the
+# merged histograms (the pixels are uint8). Everything is written to a JSON
+# stats file, which train.py and tensorflow_train.py read with --band_stats
+# to standardize each band inside the models (normalization_layer).
+
+import argparse
+import json
+import multiprocessing
+import os
+import numpy as np
+import tensorflow as tf
+
+import shard_index
+
+# kept here rather than imported, since train.py imports this module
+NUM_CLASSES = 4
+IMG_DIM = 65
+ALL_BANDS = ['B1', 'B2', 'B3', 'B4', 'B5', 'B6', 'B7', 'B8', 'B9', 'B10', 'B11']
+DATA_PATH = "data"
+SPLIT = "train"
+STATS_PATH = os.path.join("data", "band_stats.json")
+PERCENTILES = [1, 5, 25, 50, 75, 95, 99]
+# examples per bincount call
+CHUNK_SIZE = 256
+
+def shard_histograms(task):
+  """ int64 array (class, band, pixel value) of pixel counts in one shard """
+  path, bands, manifest = task
+  compression = "NONE" if manifest is None else manifest["compression"]
+  options = tf.python_io.TFRecordOptions(getattr(tf.python_io.TFRecordCompressionType, compression))
+  if manifest is not None:
+    channels = [manifest["bands"].index(band) for band in bands]
+  # one flat bin per (class, band, value), so a chunk of examples is counted
+  # with a single bincount
+  band_bins = np.arange(len(bands)) * 256
+  size = NUM_CLASSES * len(bands) * 256
+  histograms = np.zeros(size, dtype=np.int64)
+  chunk = []
+  for serialized_example in tf.python_io.tf_record_iterator(path, options):
+    feature = tf.train.Example.FromString(serialized_example).features.feature
+    label = feature['label'].int64_list.value[0]
+    if manifest is not None:
+      image = np.frombuffer(feature['image'].bytes_list.value[0], dtype=np.uint8)
+      image = image.reshape(IMG_DIM**2, len(manifest["bands"]))[:, channels]
+    else:
+      image = np.stack([np.frombuffer(feature[band].bytes_list.value[0], dtype=np.uint8)[:IMG_DIM**2]
+                        for band in bands], axis=1)
+    chunk.append((image + band_bins + label * len(bands) * 256).ravel())
+    if len(chunk) == CHUNK_SIZE:
+      histograms += np.bincount(np.concatenate(chunk), minlength=size)
+      chunk = []
+  if chunk:
+    histograms += np.bincount(np.concatenate(chunk), minlength=size)
+  return histograms.reshape(NUM_CLASSES, len(bands), 256)
+
+def stats_from_histograms(histograms, bands):
+  """ JSON-serializable stats of (class, band, value) pixel histograms """
+  totals = histograms.sum(axis=0).astype(np.float64)
+  values = np.arange(256)
+  counts = totals.sum(axis=1)
+  mean = (totals * values).sum(axis=1) / counts
+  std = np.sqrt((totals * (values - mean[:, None])**2).sum(axis=1) / counts)
+  cumulative = np.cumsum(totals, axis=1) / counts[:, None]
+  return {
+    "bands": list(bands),
+    "num_examples": int(counts[0] // IMG_DIM**2),
+    "class_counts": [int(c) for c in histograms[:, 0].sum(axis=1) // IMG_DIM**2],
+    "mean": mean.tolist(),
+    "std": std.tolist(),
+    "min": [int(np.nonzero(t)[0][0]) for t in totals],
+    "max": [int(np.nonzero(t)[0][-1]) for t in totals],
+    # smallest pixel value at or below which q percent of the pixels fall
+    "percentiles": {str(q): [int(np.searchsorted(c, q / 100.0)) for c in cumulative] for q in PERCENTILES},
+    "histograms": histograms.tolist()
+  }
+
+def compute_stats(filelist, bands, num_workers=None):
+  manifest = shard_index.read_manifest(filelist)
+  tasks = [(path, bands, manifest) for path in sorted(filelist)]
+  histograms = np.zeros((NUM_CLASSES, len(bands), 256), dtype=np.int64)
+  pool = multiprocessing.Pool(min(num_workers or multiprocessing.cpu_count(), len(tasks)))
+  try:
+    # merge each shard's partial histograms as soon as it is done
+    for i, partial in enumerate(pool.imap_unordered(shard_histograms, tasks)):
+      histograms += partial
+      print("{}/{} shards".format(i + 1, len(tasks)))
+  finally:
+    pool.close()
+    pool.join()
+  return stats_from_histograms(histograms, bands)
+
+def load_band_stats(path, bands):
+  """ (mean, std) lists of the given bands from a stats file """
+  with open(path) as f:
+    stats = json.load(f)
+  missing = [band for band in bands if band not in stats["bands"]]
+  if missing:
+    raise ValueError("{} has no stats for bands {} (rerun band_stats.py with --bands)".format(path, missing))
+  channels = [stats["bands"].index(band) for band in bands]
+  return [stats["mean"][c] for c in channels], [stats["std"][c] for c in channels]
+
+def normalization_layer(path, bands, dtype="float32"):
+  """ Keras layer standardizing each band of raw uint8 pixels with the mean
+  and standard deviation in the stats file, cast to dtype """
+  mean, std = load_band_stats(path, bands)
+  return tf.keras.layers.Lambda(
+    lambda x, mean, std, dtype: tf.cast((tf.cast(x, tf.float32) - mean) / std, dtype),
+    arguments={'mean': mean, 'std': [max(s, 1e-6) for s in std], 'dtype': dtype},
+    name='normalize_bands')
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument(
+    "-d",
+    "--data_path",
+    type=str,
+    default=DATA_PATH,
+    help="Path to data, containing the --split folder")
+  parser.add_argument(
+    "--split",
+    type=str,
+    default=SPLIT,
+    help="Data folder to compute the stats over")
+  parser.add_argument(
+    "--bands",
+    nargs="+",
+    choices=ALL_BANDS,
+    default=ALL_BANDS,
+    help="Spectral bands to compute stats for (training can use any subset of these)")
+  parser.add_argument(
+    "-o",
+    "--output",
+    type=str,
+    default=STATS_PATH,
+    help="Stats file to write")
+  parser.add_argument(
+    "-j",
+    "--num_workers",
+    type=int,
+    default=multiprocessing.cpu_count(),
+    help="Number of shards processed in parallel")
+  args = parser.parse_args()
+
+  folder = os.path.join(args.data_path, args.split)
+  filelist = [os.path.join(folder, f) for f in os.listdir(folder)
+              if f.startswith('part-') and not f.endswith('gstmp')]
+  stats = compute_stats(filelist, args.bands, args.num_workers)
+  with open(args.output, "w") as f:
+    json.dump(stats, f)
+  for band, mean, std in zip(stats["bands"], stats["mean"], stats["std"]):
+    print("{:4s} mean {:7.2f} std {:7.2f}".format(band, mean, std))
+  print("stats of {} examples written to {}".format(stats["num_examples"], args.output))
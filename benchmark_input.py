@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+# benchmark_input.py
+# --------------------
+# Measure how fast the input pipelines of train.py (Keras) and
+# tensorflow_train.py (Estimator) produce batches, without training a model.
+# Every combination of the given settings runs for a fixed number of batches
+# in its own process and reports images/sec, MB/sec, p50/p99 batch latency,
+# time to the first batch and peak RSS, as a table and as JSON.
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import resource
+import time
+import numpy as np
+
+DATA_PATH = "data"
+SPLIT = "train"
+NUM_BATCHES = 200
+WARMUP_BATCHES = 10
+OUTPUT = "input_benchmark.json"
+
+COLUMNS = ["pipeline", "batch_size", "bands", "decode", "decode_cache", "augment", "cycle_length", "shuffle_memory_mb",
+           "images_per_sec", "mb_per_sec", "p50_ms", "p99_ms", "first_batch_s", "peak_rss_mb"]
+
+def peak_rss_mb():
+  # ru_maxrss is reported in kilobytes on Linux
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def time_batches(next_batch, num_batches, warmup_batches):
+  """ Call next_batch() repeatedly, returning the time to the first batch, the
+  latencies of the timed batches and the number of images and bytes in them """
+  start = time.time()
+  next_batch()
+  first_batch = time.time() - start
+  for _ in range(warmup_batches):
+    next_batch()
+  latencies = []
+  num_images = 0
+  num_bytes = 0
+  for _ in range(num_batches):
+    start = time.time()
+    images = next_batch()
+    latencies.append(time.time() - start)
+    num_images += len(images)
+    num_bytes += images.nbytes
+  return first_batch, latencies, num_images, num_bytes
+
+def keras_batches(config, data_path):
+  import shard_index
+  import tensorflow as tf
+  import train
+  args = argparse.Namespace(**config)
+  if config["decode"] == "cache":
+    # memory-mapped arrays from convert_data.py, read the way model.fit does
+    images, _ = train.load_cached_data(config["cache_dir"], SPLIT, args.bands, one_hot=False)
+    num_batches = len(images) // args.batch_size
+    order = np.random.permutation(num_batches)
+    position = [0]
+    def next_batch():
+      i = order[position[0] % num_batches] * args.batch_size
+      position[0] += 1
+      # the uint8 rows model.fit is fed, read into memory, so MB/sec compares
+      # with the uint8 images of the TFRecord pipelines
+      return np.array(images[i:i + args.batch_size])
+    return next_batch
+
+  args.batched_decode = config["decode"] == "batched"
+  args.read_buffer_mb = train.READ_BUFFER_MB
+  args.nondeterministic = False
+  args.prefetch_device = ""
+  args.crop = train.CROP
+  args.decode_cache_dir = train.DECODE_CACHE_DIR
+  args.decode_cache_memory_mb = train.DECODE_CACHE_MEMORY_MB
+  args.survey_columns = train.SURVEY_COLUMNS
+  args.survey_key_feature = train.SURVEY_KEY_FEATURE
+  args.tabular = train.TABULAR
+  filelist = train.file_list_from_folder(SPLIT, data_path)
+  index = shard_index.load_index(filelist)
+  buffer_size = train.shuffle_buffer_size(index, args)
+  cache = train.decode_cache(filelist, shard_index.num_records(index), args)
+  image, _ = train.parse_tfrecords(filelist, args.batch_size, buffer_size, cache=cache, augment=args.augment,
+                                   manifest=shard_index.read_manifest(filelist),
+                                   **train.pipeline_options(args))
+  sess = tf.keras.backend.get_session()
+  return lambda: sess.run(image['image'])
+
+def estimator_batches(config, data_path):
+  import shard_index
+  import tensorflow as tf
+  import tensorflow_train
+  args = argparse.Namespace(**config)
+  args.crop = tensorflow_train.CROP
+  args.decode_cache_dir = tensorflow_train.DECODE_CACHE_DIR
+  args.decode_cache_memory_mb = tensorflow_train.DECODE_CACHE_MEMORY_MB
+  filelist = tensorflow_train.file_list_from_folder(SPLIT, data_path)
+  index = shard_index.load_index(filelist)
+  buffer_size = tensorflow_train.shuffle_buffer_size(index, args)
+  cache = tensorflow_train.decode_cache(filelist, shard_index.num_records(index), args)
+  image, _ = tensorflow_train.parse_tfrecords(filelist, args.batch_size, 1, buffer_size, args.bands,
+                                              cycle_length=args.cycle_length, crop=args.crop, cache=cache,
+                                              manifest=shard_index.read_manifest(filelist))
+  sess = tf.Session()
+  return lambda: sess.run(image['image'])
+
+def run_config(config, data_path, num_batches, warmup_batches):
+  if config["pipeline"] == "keras":
+    next_batch = keras_batches(config, data_path)
+  else:
+    next_batch = estimator_batches(config, data_path)
+  first_batch, latencies, num_images, num_bytes = time_batches(next_batch, num_batches, warmup_batches)
+  total = sum(latencies)
+  result = dict(config)
+  result.update({
+    "bands": ",".join(config["bands"]),
+    "images_per_sec": num_images / total,
+    "mb_per_sec": num_bytes / total / 2**20,
+    "p50_ms": 1000 * float(np.percentile(latencies, 50)),
+    "p99_ms": 1000 * float(np.percentile(latencies, 99)),
+    "first_batch_s": first_batch,
+    "peak_rss_mb": peak_rss_mb()
+  })
+  return result
+
+def configs(args):
+  seen = set()
+  for pipeline, batch_size, bands, decode, decode_cache, augment, cycle_length, shuffle_memory_mb in itertools.product(
+      args.pipelines, args.batch_sizes, args.band_sets, args.decode, args.decode_cache, args.augment,
+      args.cycle_lengths, args.shuffle_memory_mb):
+    augment = augment == "on"
+    if pipeline == "estimator" and (decode != "example" or augment):
+      continue
+    if decode == "cache":
+      if not args.cache_dir:
+        continue
+      # TFRecord pipeline settings do not apply to the cache
+      decode_cache, augment, cycle_length, shuffle_memory_mb = None, None, None, None
+    key = (pipeline, batch_size, bands, decode, decode_cache, augment, cycle_length, shuffle_memory_mb)
+    if key in seen:
+      continue
+    seen.add(key)
+    yield {
+      "pipeline": pipeline,
+      "batch_size": batch_size,
+      "bands": bands.split(","),
+      "decode": decode,
+      "decode_cache": decode_cache,
+      "augment": augment,
+      "cycle_length": cycle_length,
+      "shuffle_memory_mb": shuffle_memory_mb,
+      "cache_dir": args.cache_dir
+    }
+
+def format_table(results, columns=COLUMNS):
+  def fmt(value):
+    return "{:.1f}".format(value) if isinstance(value, float) else str(value)
+  rows = [columns] + [[fmt(result[column]) for column in columns] for result in results]
+  widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+  return "\n".join("  ".join(cell.rjust(width) for cell, width in zip(row, widths)) for row in rows)
+
+def benchmark(args):
+  results = []
+  # a fresh process per configuration keeps peak RSS and TF state separate;
+  # spawn rather than fork so no TensorFlow runtime is inherited
+  context = multiprocessing.get_context("spawn")
+  for config in configs(args):
+    print("running {}".format(config))
+    pool = context.Pool(1)
+    try:
+      results.append(pool.apply(run_config, (config, args.data_path, args.num_batches, args.warmup_batches)))
+    finally:
+      pool.close()
+      pool.join()
+  print(format_table(results))
+  with open(args.output, "w") as f:
+    json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument(
+    "-d",
+    "--data_path",
+    type=str,
+    default=DATA_PATH,
+    help="Path to data, containing train/")
+  parser.add_argument(
+    "-c",
+    "--cache_dir",
+    type=str,
+    default="",
+    help="Also benchmark the memory-mapped arrays written by convert_data.py")
+  parser.add_argument(
+    "--pipelines",
+    nargs="+",
+    choices=["keras", "estimator"],
+    default=["keras", "estimator"],
+    help="Input pipelines to benchmark")
+  parser.add_argument(
+    "--batch_sizes",
+    nargs="+",
+    type=int,
+    default=[64],
+    help="Batch sizes to benchmark")
+  parser.add_argument(
+    "--band_sets",
+    nargs="+",
+    default=["B2,B3,B4,B5,B6,B7,B8"],
+    help="Comma-separated band subsets to benchmark")
+  parser.add_argument(
+    "--decode",
+    nargs="+",
+    choices=["example", "batched", "cache"],
+    default=["example", "batched", "cache"],
+    help="Decode modes: per-example, batched (train.py --batched_decode) or memory-mapped cache")
+  parser.add_argument(
+    "--decode_cache",
+    nargs="+",
+    choices=["none", "memory", "disk"],
+    default=["none"],
+    help="tf.data decode cache settings (run more batches than one epoch to see cached reads)")
+  parser.add_argument(
+    "--augment",
+    nargs="+",
+    choices=["off", "on"],
+    default=["off"],
+    help="Batch augmentation settings (train.py --augment)")
+  parser.add_argument(
+    "--cycle_lengths",
+    nargs="+",
+    type=int,
+    default=[16],
+    help="Numbers of shards read in parallel")
+  parser.add_argument(
+    "--shuffle_memory_mb",
+    nargs="+",
+    type=int,
+    default=[512],
+    help="Shuffle buffer memory budgets in MB")
+  parser.add_argument(
+    "-n",
+    "--num_batches",
+    type=int,
+    default=NUM_BATCHES,
+    help="Number of timed batches per configuration")
+  parser.add_argument(
+    "--warmup_batches",
+    type=int,
+    default=WARMUP_BATCHES,
+    help="Number of untimed batches after the first one")
+  parser.add_argument(
+    "-o",
+    "--output",
+    type=str,
+    default=OUTPUT,
+    help="JSON file to write the results to")
+  args = parser.parse_args()
+
+  benchmark(args)
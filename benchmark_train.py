@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+# benchmark_train.py
+# --------------------
+# Time training steps (forward and backward pass) of the Keras models in
+# train.py and the Estimator models in tensorflow_train.py on synthetic
+# 65x65xbands uint8 images, across batch sizes and TensorFlow thread counts.
+# Needs neither the real dataset nor wandb, so model changes can be
+# benchmarked in isolation on a CPU-only machine. Each configuration runs in
+# its own process and reports steps/sec, images/sec and peak RSS, as a table
+# and as JSON. keras_tabular is the classification CNN with the survey feature
+# branch (train.py --tabular), to compare against keras_classification.
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import shutil
+import tempfile
+import time
+import numpy as np
+import tensorflow as tf
+
+import survey_data
+import tensorflow_train
+import train
+from benchmark_input import format_table, peak_rss_mb
+
+MODELS = ["keras_classification", "keras_tabular", "keras_regression", "estimator_test", "estimator_original"]
+NUM_STEPS = 50
+WARMUP_STEPS = 5
+OUTPUT = "train_benchmark.json"
+
+COLUMNS = ["model", "precision", "batch_size", "threads", "bands", "steps_per_sec", "images_per_sec",
+           "p50_ms", "peak_rss_mb"]
+
+def session_config(threads):
+  # 0 lets TensorFlow pick the number of threads
+  return tf.ConfigProto(intra_op_parallelism_threads=threads, inter_op_parallelism_threads=threads)
+
+def synthetic_batch(batch_size, img_dim, num_bands, regression):
+  rng = np.random.RandomState(1)
+  images = rng.randint(0, 256, size=(batch_size, img_dim, img_dim, num_bands)).astype(np.uint8)
+  labels = rng.randint(0, 4, size=batch_size)
+  if regression:
+    return images, (labels / 3.0).astype(np.float32).reshape(-1, 1)
+  return images, np.eye(4, dtype=np.float32)[labels]
+
+def time_keras_steps(config, num_steps, warmup_steps):
+  tf.keras.backend.set_session(tf.Session(config=session_config(config["threads"])))
+  args = argparse.Namespace(**config)
+  if config["model"] == "keras_regression":
+    model = train.build_regression_model(args)
+  else:
+    model = train.build_classification_model(args)
+  images, labels = synthetic_batch(args.batch_size, train.crop_size(args.crop), len(args.bands),
+                                   config["model"] == "keras_regression")
+  inputs = {'image': images}
+  if args.tabular:
+    num_features = len(survey_data.TABULAR_FEATURES)
+    inputs['survey'] = np.random.RandomState(1).randn(args.batch_size, num_features).astype(np.float32)
+  for _ in range(warmup_steps):
+    model.train_on_batch(inputs, labels)
+  latencies = []
+  for _ in range(num_steps):
+    start = time.time()
+    model.train_on_batch(inputs, labels)
+    latencies.append(time.time() - start)
+  return latencies
+
+class StepTimerHook(tf.train.SessionRunHook):
+  """ Estimator hook recording the wall time of every training step """
+  def __init__(self):
+    self.latencies = []
+
+  def before_run(self, run_context):
+    self.start = time.time()
+
+  def after_run(self, run_context, run_values):
+    self.latencies.append(time.time() - self.start)
+
+def time_estimator_steps(config, num_steps, warmup_steps):
+  args = argparse.Namespace(**config)
+  model_dir = tempfile.mkdtemp()
+  try:
+    run_config = tf.estimator.RunConfig(model_dir=model_dir, session_config=session_config(config["threads"]))
+    if config["model"] == "estimator_original":
+      estimator = tensorflow_train.build_estimator_from_model_original(args, run_config)
+    else:
+      estimator = tensorflow_train.build_estimator_from_model_test(args, run_config)
+    images, labels = synthetic_batch(args.batch_size, tensorflow_train.crop_size(args.crop), len(args.bands), True)
+    input_fn = lambda: tf.data.Dataset.from_tensors(({'image': images}, labels)).repeat()
+    timer = StepTimerHook()
+    estimator.train(input_fn, steps=warmup_steps + num_steps, hooks=[timer])
+    return timer.latencies[warmup_steps:]
+  finally:
+    shutil.rmtree(model_dir, ignore_errors=True)
+
+def run_config(config, num_steps, warmup_steps):
+  if config["model"].startswith("keras"):
+    latencies = time_keras_steps(config, num_steps, warmup_steps)
+  else:
+    latencies = time_estimator_steps(config, num_steps, warmup_steps)
+  total = sum(latencies)
+  result = dict(config)
+  result.update({
+    "bands": len(config["bands"]),
+    "steps_per_sec": len(latencies) / total,
+    "images_per_sec": len(latencies) * config["batch_size"] / total,
+    "p50_ms": 1000 * float(np.percentile(latencies, 50)),
+    "peak_rss_mb": peak_rss_mb()
+  })
+  return result
+
+def configs(args):
+  for model, precision, batch_size, threads in itertools.product(args.models, args.precisions,
+                                                                 args.batch_sizes, args.threads):
+    # only the Keras classification CNNs have a precision setting
+    if precision != "float32" and model not in ["keras_classification", "keras_tabular"]:
+      continue
+    config = {"model": model, "precision": precision, "batch_size": batch_size, "threads": threads}
+    if model.startswith("keras"):
+      config.update({
+        "bands": train.BANDS,
+        "crop": train.CROP,
+        "l1_size": train.L1_SIZE,
+        "l2_size": train.L2_SIZE,
+        "l3_size": train.L3_SIZE,
+        "fc1_size": train.FC1_SIZE,
+        "fc2_size": train.FC2_SIZE,
+        "dropout_1": train.DROPOUT_1,
+        "dropout_2": train.DROPOUT_2,
+        "optimizer": train.OPTIMIZER,
+        "learning_rate": train.LEARNING_RATE,
+        "tabular": model == "keras_tabular",
+        "tabular_size": train.TABULAR_SIZE,
+        "band_stats": train.BAND_STATS
+      })
+    else:
+      config.update({
+        "bands": tensorflow_train.BANDS,
+        "crop": tensorflow_train.CROP,
+        "l1_size": tensorflow_train.L1_SIZE,
+        "l2_size": tensorflow_train.L2_SIZE,
+        "fc_size": tensorflow_train.FC_SIZE,
+        "band_stats": tensorflow_train.BAND_STATS
+      })
+    yield config
+
+def benchmark(args):
+  results = []
+  # a fresh process per configuration keeps thread settings and peak RSS
+  # separate; spawn rather than fork so no TensorFlow runtime is inherited
+  context = multiprocessing.get_context("spawn")
+  for config in configs(args):
+    print("running {} precision={} batch_size={} threads={}".format(
+      config["model"], config["precision"], config["batch_size"], config["threads"]))
+    pool = context.Pool(1)
+    try:
+      results.append(pool.apply(run_config, (config, args.num_steps, args.warmup_steps)))
+    finally:
+      pool.close()
+      pool.join()
+  print(format_table(results, COLUMNS))
+  with open(args.output, "w") as f:
+    json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument(
+    "--models",
+    nargs="+",
+    choices=MODELS,
+    default=MODELS,
+    help="Models to benchmark")
+  parser.add_argument(
+    "--precisions",
+    nargs="+",
+    choices=["float32", "bfloat16"],
+    default=["float32", "bfloat16"],
+    help="Compute precisions of the Keras classification CNN (train.py --precision)")
+  parser.add_argument(
+    "--batch_sizes",
+    nargs="+",
+    type=int,
+    default=[32, 64, 128],
+    help="Batch sizes to benchmark")
+  parser.add_argument(
+    "--threads",
+    nargs="+",
+    type=int,
+    default=[0],
+    help="TensorFlow intra/inter-op thread counts to benchmark (0 = TensorFlow default)")
+  parser.add_argument(
+    "-n",
+    "--num_steps",
+    type=int,
+    default=NUM_STEPS,
+    help="Number of timed training steps per configuration")
+  parser.add_argument(
+    "--warmup_steps",
+    type=int,
+    default=WARMUP_STEPS,
+    help="Number of untimed training steps before timing")
+  parser.add_argument(
+    "-o",
+    "--output",
+    type=str,
+    default=OUTPUT,
+    help="JSON file to write the results to")
+  args = parser.parse_args()
+
+  benchmark(args)
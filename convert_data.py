@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+# convert_data.py
+# --------------------
+# One-time conversion of the train/val TFRecords into memory-mapped NumPy
+# arrays, so repeated training runs read raw uint8 pixels from the page cache
+# instead of re-parsing protobufs every epoch. For each split this writes:
+#   <split>_images.npy  uint8 array of shape (N, 65, 65, bands)
+#   <split>_labels.npy  uint8 array of shape (N,) with labels 0-3
+#   <split>_index.json  image count, band list and per-shard row ranges
+# Load the result in train.py with --cache_dir.
+
+import argparse
+import json
+import os
+import numpy as np
+import tensorflow as tf
+
+from train import ALL_BANDS, BANDS, IMG_DIM, file_list_from_folder
+
+DATA_PATH = "data"
+CACHE_DIR = os.path.join("data", "cache")
+SPLITS = ["train", "val"]
+
+def count_records(path):
+  return sum(1 for _ in tf.python_io.tf_record_iterator(path))
+
+def example_to_arrays(serialized_example, bands):
+  example = tf.train.Example.FromString(serialized_example)
+  feature = example.features.feature
+  image = np.empty((IMG_DIM, IMG_DIM, len(bands)), dtype=np.uint8)
+  for i, band in enumerate(bands):
+    raw = np.frombuffer(feature[band].bytes_list.value[0], dtype=np.uint8)
+    image[:, :, i] = raw[:IMG_DIM**2].reshape(IMG_DIM, IMG_DIM)
+  label = feature['label'].int64_list.value[0]
+  return image, label
+
+def convert_split(split, data_path, cache_dir, bands):
+  filelist = sorted(file_list_from_folder(split, data_path))
+  counts = [count_records(path) for path in filelist]
+  num_images = sum(counts)
+  print("{}: {} images in {} shards".format(split, num_images, len(filelist)))
+
+  images = np.lib.format.open_memmap(os.path.join(cache_dir, split + "_images.npy"), mode="w+",
+                                     dtype=np.uint8, shape=(num_images, IMG_DIM, IMG_DIM, len(bands)))
+  labels = np.lib.format.open_memmap(os.path.join(cache_dir, split + "_labels.npy"), mode="w+",
+                                     dtype=np.uint8, shape=(num_images,))
+  shards = []
+  row = 0
+  for path, count in zip(filelist, counts):
+    shards.append({"path": path, "start": row, "count": count})
+    for serialized_example in tf.python_io.tf_record_iterator(path):
+      images[row], labels[row] = example_to_arrays(serialized_example, bands)
+      row += 1
+  images.flush()
+  labels.flush()
+  del images, labels
+
+  index = {
+    "count": num_images,
+    "img_dim": IMG_DIM,
+    "bands": bands,
+    "shards": shards
+  }
+  with open(os.path.join(cache_dir, split + "_index.json"), "w") as f:
+    json.dump(index, f, indent=2)
+
+def convert(args):
+  if not os.path.isdir(args.cache_dir):
+    os.makedirs(args.cache_dir)
+  for split in args.splits:
+    convert_split(split, args.data_path, args.cache_dir, args.bands)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument(
+    "-d",
+    "--data_path",
+    type=str,
+    default=DATA_PATH,
+    help="Path to data, containing train/ and val/")
+  parser.add_argument(
+    "-c",
+    "--cache_dir",
+    type=str,
+    default=CACHE_DIR,
+    help="Output directory for the memory-mapped arrays")
+  parser.add_argument(
+    "--bands",
+    nargs="+",
+    choices=ALL_BANDS,
+    default=BANDS,
+    help="Spectral bands to store (must match train.py --bands)")
+  parser.add_argument(
+    "--splits",
+    nargs="+",
+    default=SPLITS,
+    help="Data folders to convert")
+  args = parser.parse_args()
+
+  convert(args)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+# evaluate.py
+# --------------------
+# Evaluate a trained model on a whole split. The validation in train.py is
+# the accuracy over floor(NUM_VAL / batch_size) steps of the shuffled,
+# repeating training pipeline, which scores some tiles twice and others not
+# at all. Here every record of the --split shards (or of the convert_data.py
+# arrays) is scored exactly once: the shards are read in parallel, without
+# shuffling or repeating, and decoded and scored in large batches (the same
+# pipeline as predict.py). Only a running confusion matrix is kept, from
+# which the accuracy, per-class precision/recall/F1 and the mean absolute
+# error of the predicted number of cows are computed at the end. The report
+# is printed as a table and written as JSON.
+
+import argparse
+import json
+import time
+import numpy as np
+
+from benchmark_input import format_table
+import predict
+import tensorflow_train
+import train
+
+OUTPUT = "evaluation.json"
+BATCH_SIZE = 1024
+
+COLUMNS = ["class", "support", "predicted", "precision", "recall", "f1"]
+
+def metrics_from_confusion(confusion):
+  """ Report dict of a confusion matrix (rows: true cows, columns: predicted) """
+  confusion = confusion.astype(np.float64)
+  total = confusion.sum()
+  support = confusion.sum(axis=1)
+  predicted = confusion.sum(axis=0)
+  correct = np.diag(confusion)
+  # a class that is never predicted (or never present) has precision (recall) 0
+  precision = correct / np.maximum(predicted, 1)
+  recall = correct / np.maximum(support, 1)
+  f1 = 2 * precision * recall / np.maximum(precision + recall, 1e-12)
+  cows = np.arange(len(confusion))
+  errors = np.abs(cows[:, None] - cows[None, :])
+  return {
+    "num_examples": int(total),
+    "accuracy": float(correct.sum() / max(total, 1)),
+    "mean_absolute_error": float((confusion * errors).sum() / max(total, 1)),
+    "macro_precision": float(precision.mean()),
+    "macro_recall": float(recall.mean()),
+    "macro_f1": float(f1.mean()),
+    "classes": [{"class": int(c), "support": int(support[c]), "predicted": int(predicted[c]),
+                 "precision": float(precision[c]), "recall": float(recall[c]), "f1": float(f1[c])}
+                for c in cows],
+    "confusion_matrix": confusion.astype(np.int64).tolist()
+  }
+
+def format_confusion(confusion):
+  width = max(len(str(int(np.max(confusion)))), len("pred 0"))
+  lines = ["true \\ " + " ".join("pred {}".format(c).rjust(width) for c in range(len(confusion)))]
+  for c, row in enumerate(confusion):
+    lines.append("{:6d} ".format(c) + " ".join(str(n).rjust(width) for n in row))
+  return "\n".join(lines)
+
+def evaluate(args):
+  model, classification = predict.load_model(args)
+  predict.check_input_shape(model, args)
+  if args.cache_dir:
+    _, batches = predict.array_batches(model, args)
+  else:
+    _, batches = predict.tfrecord_batches(model, args, labeled=True)
+
+  confusion = np.zeros((train.NUM_CLASSES, train.NUM_CLASSES), dtype=np.int64)
+  start = time.time()
+  for i, (_, _, outputs, labels) in enumerate(batches):
+    cows = predict.predicted_cows(outputs, classification)
+    confusion += np.bincount(labels * train.NUM_CLASSES + cows,
+                             minlength=train.NUM_CLASSES**2).reshape(confusion.shape)
+    if (i + 1) % args.log_every == 0:
+      count = confusion.sum()
+      print("{} tiles, {:.1f} tiles/sec".format(count, count / (time.time() - start)))
+  elapsed = time.time() - start
+
+  report = metrics_from_confusion(confusion)
+  report.update({"model": args.model, "split": args.split, "seconds": elapsed,
+                 "tiles_per_sec": report["num_examples"] / max(elapsed, 1e-6)})
+  # format_table shows floats to one decimal
+  print(format_table([{name: "{:.4f}".format(value) if isinstance(value, float) else value
+                       for name, value in row.items()} for row in report["classes"]], COLUMNS))
+  print(format_confusion(confusion))
+  print("accuracy {:.4f}  mean absolute cow-count error {:.4f}  macro F1 {:.4f}".format(
+    report["accuracy"], report["mean_absolute_error"], report["macro_f1"]))
+  print("evaluated {} tiles in {:.1f}s ({:.1f} tiles/sec)".format(
+    report["num_examples"], elapsed, report["tiles_per_sec"]))
+  with open(args.output, "w") as f:
+    json.dump(report, f, indent=2)
+  return report
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument(
+    "model",
+    type=str,
+    help="train.py model (.h5) or tensorflow_train.py --model_dir")
+  parser.add_argument(
+    "-d",
+    "--data_path",
+    type=str,
+    default=predict.DATA_PATH,
+    help="Path to data, containing the --split folder of part-* TFRecords")
+  parser.add_argument(
+    "-c",
+    "--cache_dir",
+    type=str,
+    default="",
+    help="Evaluate on the memory-mapped arrays written by convert_data.py instead of TFRecords")
+  parser.add_argument(
+    "--split",
+    type=str,
+    default=predict.SPLIT,
+    help="Data folder (or cached split) to evaluate on")
+  parser.add_argument(
+    "-o",
+    "--output",
+    type=str,
+    default=OUTPUT,
+    help="JSON file to write the report to")
+  parser.add_argument(
+    "-b",
+    "--batch_size",
+    type=int,
+    default=BATCH_SIZE,
+    help="Number of tiles per batch; no gradients are kept, so this can be far larger than in training")
+  parser.add_argument(
+    "--bands",
+    nargs="+",
+    choices=train.ALL_BANDS,
+    default=train.BANDS,
+    help="Spectral bands the model was trained on (tensorflow_train.py uses B2-B11)")
+  parser.add_argument(
+    "--cycle_length",
+    type=int,
+    default=predict.CYCLE_LENGTH,
+    help="Number of shards read in parallel")
+  parser.add_argument(
+    "--read_buffer_mb",
+    type=int,
+    default=predict.READ_BUFFER_MB,
+    help="Read buffer size in MB for each shard")
+  parser.add_argument(
+    "--l1_size",
+    type=int,
+    default=tensorflow_train.L1_SIZE,
+    help="Size of the first conv layer of a tensorflow_train.py model")
+  parser.add_argument(
+    "--l2_size",
+    type=int,
+    default=tensorflow_train.L2_SIZE,
+    help="Size of the second conv layer of a tensorflow_train.py model")
+  parser.add_argument(
+    "--fc_size",
+    type=int,
+    default=tensorflow_train.FC_SIZE,
+    help="Size of the dense layer of a tensorflow_train.py model")
+  parser.add_argument(
+    "--band_stats",
+    type=str,
+    default=tensorflow_train.BAND_STATS,
+    help="Stats file a tensorflow_train.py model was trained with (train.py models record their own)")
+  parser.add_argument(
+    "--crop",
+    type=int,
+    default=train.CROP,
+    help="Center crop of a tensorflow_train.py model (train.py models record their own)")
+  parser.add_argument(
+    "--log_every",
+    type=int,
+    default=predict.LOG_EVERY,
+    help="Batches between progress reports")
+  args = parser.parse_args()
+
+  evaluate(args)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+# launch_cluster.py
+# --------------------
+# Run distributed training as a cluster of local processes: every process
+# gets a TF_CONFIG describing the whole cluster (one port per task on
+# localhost) and its own task, and all remaining arguments are passed to the
+# training script. Useful to test distributed training on one machine before
+# running it across hosts, and to measure the speedup over one process:
+#   python launch_cluster.py -n 2 -- -d data -b 32 -e 1
+# runs train.py --distribute multi_worker on two workers, and
+#   python launch_cluster.py --estimator -n 2 --num_ps 1 -- -d data
+# runs tensorflow_train.py with a chief, a worker and a parameter server
+# sharing one checkpoint directory. Only the first worker (the chief) logs to
+# wandb; the others run it in dryrun mode.
+
+import argparse
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+DATA_PATH = "data"
+NUM_WORKERS = 2
+NUM_PS = 1
+BASE_PORT = 12345
+
+def cluster_spec(args):
+  """ {task type: [address]} with num_workers training processes; in
+  Estimator mode the first of them is the chief """
+  ports = itertools.count(args.base_port)
+  if not args.estimator:
+    return {"worker": ["localhost:{}".format(next(ports)) for _ in range(args.num_workers)]}
+  cluster = {"chief": ["localhost:{}".format(next(ports))]}
+  if args.num_workers > 1:
+    cluster["worker"] = ["localhost:{}".format(next(ports)) for _ in range(args.num_workers - 1)]
+  if args.num_ps:
+    cluster["ps"] = ["localhost:{}".format(next(ports)) for _ in range(args.num_ps)]
+  return cluster
+
+def tasks(args, cluster):
+  """ (task type, index) of every process to start; the evaluator is not part
+  of the cluster spec but still needs a TF_CONFIG """
+  for task_type in ["chief", "worker", "ps"]:
+    for index in range(len(cluster.get(task_type, []))):
+      yield task_type, index
+  if args.estimator and args.evaluator:
+    yield "evaluator", 0
+
+def build_index(args, script_args):
+  """ Index the shards of the training script's --data_path once, before
+  any task starts, so the tasks load a current index instead of all
+  indexing the same shards at the same time. With survey inputs, the survey
+  join is built up front for the same reason. """
+  parser = argparse.ArgumentParser(add_help=False)
+  parser.add_argument("-d", "--data_path", default=DATA_PATH)
+  parser.add_argument("--survey_columns", nargs="+", default=[])
+  parser.add_argument("--survey_key_feature", default=None)
+  parser.add_argument("--tabular", action="store_true")
+  options = parser.parse_known_args(script_args)[0]
+  splits = ["train", "test"] if args.estimator else ["train", "val"]
+  folders = [os.path.join(options.data_path, split) for split in splits
+             if os.path.isdir(os.path.join(options.data_path, split))]
+  if folders:
+    subprocess.check_call([sys.executable, "shard_index.py"] + folders)
+  if folders and not args.estimator and (options.survey_columns or options.tabular):
+    key_feature = [] if options.survey_key_feature is None else ["--key_feature", options.survey_key_feature]
+    subprocess.check_call([sys.executable, "survey_join.py"] + folders + key_feature)
+
+def launch(args, script_args):
+  cluster = cluster_spec(args)
+  if args.estimator:
+    command = [sys.executable, "tensorflow_train.py"]
+    if "--model_dir" not in script_args:
+      # every task must read and write the same checkpoints
+      command += ["--model_dir", tempfile.mkdtemp(prefix="estimator-cluster-")]
+  else:
+    command = [sys.executable, "train.py", "--distribute", "multi_worker"]
+  command += script_args
+  build_index(args, script_args)
+
+  start = time.time()
+  trainers = []
+  servers = []
+  for task_type, index in tasks(args, cluster):
+    env = dict(os.environ)
+    env["TF_CONFIG"] = json.dumps({"cluster": cluster, "task": {"type": task_type, "index": index}})
+    if task_type != "chief" and (args.estimator or index > 0):
+      env["WANDB_MODE"] = "dryrun"
+    print("{} {}: {}".format(task_type, index, " ".join(command)))
+    process = subprocess.Popen(command, env=env)
+    # parameter servers serve until they are stopped
+    (servers if task_type == "ps" else trainers).append(process)
+  try:
+    status = max(process.wait() for process in trainers)
+  except KeyboardInterrupt:
+    for process in trainers:
+      process.terminate()
+    raise
+  finally:
+    for process in servers:
+      process.terminate()
+  print("cluster finished in {:.1f}s".format(time.time() - start))
+  return status
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument(
+    "-n",
+    "--num_workers",
+    type=int,
+    default=NUM_WORKERS,
+    help="Number of local training processes (including the chief in Estimator mode)")
+  parser.add_argument(
+    "--estimator",
+    action="store_true",
+    help="Run tensorflow_train.py as a chief/worker/ps cluster instead of train.py multi-worker")
+  parser.add_argument(
+    "--num_ps",
+    type=int,
+    default=NUM_PS,
+    help="Number of parameter servers (Estimator mode)")
+  parser.add_argument(
+    "--evaluator",
+    action="store_true",
+    help="Also start an evaluator task (Estimator mode)")
+  parser.add_argument(
+    "--base_port",
+    type=int,
+    default=BASE_PORT,
+    help="Port of the first task, later tasks use the following ports")
+  args, script_args = parser.parse_known_args()
+  if script_args[:1] == ["--"]:
+    script_args = script_args[1:]
+
+  sys.exit(launch(args, script_args))
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+# load_test.py
+# --------------------
+# Load generator for serve.py: for every concurrency level, that many client
+# threads send /predict requests of random uint8 tiles back to back for a
+# fixed number of requests, and the client-side p50/p99 latency, requests/sec
+# and tiles/sec are reported as a table and as JSON, along with the mean
+# batch size the server formed.
+
+import argparse
+import base64
+import json
+import threading
+import time
+import urllib.request
+import numpy as np
+
+from benchmark_input import format_table
+
+URL = "http://127.0.0.1:8500"
+NUM_REQUESTS = 500
+TILES_PER_REQUEST = 1
+IMG_DIM = 65
+NUM_BANDS = 7
+OUTPUT = "load_test.json"
+
+COLUMNS = ["concurrency", "tiles_per_request", "requests_per_sec", "tiles_per_sec", "p50_ms", "p99_ms",
+           "errors", "mean_batch_size"]
+
+def get_json(url):
+  with urllib.request.urlopen(url) as response:
+    return json.loads(response.read().decode("utf-8"))
+
+def request_body(tiles_per_request, img_dim, num_bands, rng):
+  tiles = rng.randint(0, 256, size=(tiles_per_request, img_dim, img_dim, num_bands)).astype(np.uint8)
+  return json.dumps({"b64": [base64.b64encode(tile.tobytes()).decode("ascii") for tile in tiles]}).encode("utf-8")
+
+def run_level(args, concurrency):
+  rng = np.random.RandomState(1)
+  # a few distinct bodies, built up front so encoding is not timed
+  bodies = [request_body(args.tiles_per_request, args.img_dim, args.num_bands, rng) for _ in range(8)]
+  latencies = []
+  errors = [0]
+  lock = threading.Lock()
+  remaining = [args.num_requests]
+
+  def client():
+    while True:
+      with lock:
+        if remaining[0] == 0:
+          return
+        remaining[0] -= 1
+        body = bodies[remaining[0] % len(bodies)]
+      request = urllib.request.Request(args.url + "/predict", data=body,
+                                       headers={"Content-Type": "application/json"})
+      start = time.time()
+      try:
+        with urllib.request.urlopen(request) as response:
+          response.read()
+      except Exception:
+        with lock:
+          errors[0] += 1
+        continue
+      with lock:
+        latencies.append(time.time() - start)
+
+  batches_before = get_json(args.url + "/metrics")["batch_size"]
+  start = time.time()
+  threads = [threading.Thread(target=client) for _ in range(concurrency)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  elapsed = time.time() - start
+  batches_after = get_json(args.url + "/metrics")["batch_size"]
+  num_batches = batches_after["count"] - batches_before["count"]
+  batched_tiles = batches_after["mean"] * batches_after["count"] - batches_before["mean"] * batches_before["count"]
+
+  return {
+    "concurrency": concurrency,
+    "tiles_per_request": args.tiles_per_request,
+    "requests_per_sec": len(latencies) / elapsed,
+    "tiles_per_sec": len(latencies) * args.tiles_per_request / elapsed,
+    "p50_ms": 1000 * float(np.percentile(latencies, 50)) if latencies else 0.0,
+    "p99_ms": 1000 * float(np.percentile(latencies, 99)) if latencies else 0.0,
+    "errors": errors[0],
+    "mean_batch_size": batched_tiles / num_batches if num_batches else 0.0
+  }
+
+def load_test(args):
+  results = []
+  for concurrency in args.concurrency:
+    print("running {} requests at concurrency {}".format(args.num_requests, concurrency))
+    results.append(run_level(args, concurrency))
+  print(format_table(results, COLUMNS))
+  with open(args.output, "w") as f:
+    json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument(
+    "--url",
+    type=str,
+    default=URL,
+    help="Base URL of serve.py")
+  parser.add_argument(
+    "--concurrency",
+    nargs="+",
+    type=int,
+    default=[1, 4, 16, 64],
+    help="Numbers of concurrent clients to test")
+  parser.add_argument(
+    "-n",
+    "--num_requests",
+    type=int,
+    default=NUM_REQUESTS,
+    help="Number of requests per concurrency level")
+  parser.add_argument(
+    "--tiles_per_request",
+    type=int,
+    default=TILES_PER_REQUEST,
+    help="Number of tiles in every request")
+  parser.add_argument(
+    "--img_dim",
+    type=int,
+    default=IMG_DIM,
+    help="Side of the tiles the model expects (train.py --crop, or 65)")
+  parser.add_argument(
+    "--num_bands",
+    type=int,
+    default=NUM_BANDS,
+    help="Number of bands the model expects")
+  parser.add_argument(
+    "-o",
+    "--output",
+    type=str,
+    default=OUTPUT,
+    help="JSON file to write the results to")
+  args = parser.parse_args()
+
+  load_test(args)
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+
+# predict.py
+# --------------------
+# Batch inference: score satellite tiles with a model trained by train.py
+# (the .h5 file saved to --model_name) or by tensorflow_train.py (the
+# checkpoints in its --model_dir). Tiles are streamed from part-* TFRecords,
+# which need no labels, through a parallel batched decode, or from the
+# memory-mapped arrays written by convert_data.py, so memory stays bounded
+# however many tiles there are. For every tile the output holds its source
+# shard and record number, the class probabilities (train.py models) or the
+# regression score (tensorflow_train.py models) and the predicted number of
+# cows, written one column at a time as either
+#   columns  a directory with one raw little-endian file per column and a
+#            columns.json describing them (read it back with load_columns)
+#   parquet  a single Parquet file (needs pyarrow)
+
+import argparse
+import json
+import os
+import time
+import numpy as np
+import tensorflow as tf
+
+import shard_index
+import tensorflow_train
+import train
+
+DATA_PATH = "data"
+SPLIT = "val"
+OUTPUT = "predictions"
+FORMAT = "columns"
+BATCH_SIZE = 1024
+CYCLE_LENGTH = 16
+READ_BUFFER_MB = 8
+LOG_EVERY = 100
+COLUMNS_FILENAME = "columns.json"
+
+# output writers
+#--------------------------------
+class ColumnWriter(object):
+  """ Appends batches of 1-D columns to one raw file per column """
+  def __init__(self, path, dtypes, metadata):
+    if not os.path.isdir(path):
+      os.makedirs(path)
+    self.path = path
+    self.dtypes = dtypes
+    self.metadata = metadata
+    self.count = 0
+    self.files = {name: open(os.path.join(path, name + ".bin"), "wb") for name in dtypes}
+
+  def write(self, batch):
+    for name, f in self.files.items():
+      f.write(np.ascontiguousarray(batch[name], dtype=self.dtypes[name]).tobytes())
+    self.count += len(batch["record"])
+
+  def close(self):
+    for f in self.files.values():
+      f.close()
+    schema = {
+      "count": self.count,
+      "columns": {name: np.dtype(dtype).str for name, dtype in self.dtypes.items()},
+      "metadata": self.metadata
+    }
+    with open(os.path.join(self.path, COLUMNS_FILENAME), "w") as f:
+      json.dump(schema, f, indent=2)
+
+class ParquetWriter(object):
+  """ Appends batches of 1-D columns to a Parquet file, one row group per
+  batch """
+  def __init__(self, path, dtypes, metadata):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    self.pa = pa
+    fields = [pa.field(name, pa.from_numpy_dtype(np.dtype(dtype))) for name, dtype in dtypes.items()]
+    schema = pa.schema(fields, metadata={"predict": json.dumps(metadata)})
+    self.dtypes = dtypes
+    self.writer = pq.ParquetWriter(path, schema)
+
+  def write(self, batch):
+    arrays = [self.pa.array(np.asarray(batch[name], dtype=dtype)) for name, dtype in self.dtypes.items()]
+    self.writer.write_table(self.pa.Table.from_arrays(arrays, names=list(self.dtypes)))
+
+  def close(self):
+    self.writer.close()
+
+def load_columns(path):
+  """ {column: memory-mapped array} and the metadata of a columns output """
+  with open(os.path.join(path, COLUMNS_FILENAME)) as f:
+    schema = json.load(f)
+  columns = {name: np.memmap(os.path.join(path, name + ".bin"), dtype=np.dtype(dtype), mode="r",
+                             shape=(schema["count"],))
+             for name, dtype in schema["columns"].items()}
+  return columns, schema["metadata"]
+
+# models
+#--------------------------------
+def load_model(args):
+  """ (Keras model, True for class probabilities or False for a regression
+  score) from a train.py .h5 file or a tensorflow_train.py model_dir """
+  if os.path.isdir(args.model):
+    checkpoint = tf.train.latest_checkpoint(args.model)
+    if checkpoint is None:
+      raise IOError("no checkpoint in {}".format(args.model))
+    model = tensorflow_train.build_model_test(args)
+    # the estimator checkpoints the Keras variables under their own names
+    saver = tf.train.Saver(var_list={weight.op.name: weight for weight in model.weights})
+    saver.restore(tf.keras.backend.get_session(), checkpoint)
+    return model, False
+  # the Lambda layers of train.py models refer to tf
+  model = tf.keras.models.load_model(args.model, custom_objects={'tf': tf}, compile=False)
+  return model, model.output_shape[-1] > 1
+
+def predicted_cows(outputs, classification):
+  """ Number of cows per row of model outputs: the most probable class, or the
+  nearest count to a regression score (the label divided by 3) """
+  if classification:
+    return np.argmax(outputs, axis=1)
+  return np.clip(np.round(outputs[:, 0] * 3), 0, train.NUM_CLASSES - 1).astype(np.int64)
+
+def check_input_shape(model, args):
+  """ Take the crop from the model input and check it expects --bands """
+  if isinstance(model.input_shape, list):
+    raise ValueError("model takes survey features as well (train.py --tabular); only image models are supported")
+  _, height, _, num_bands = model.input_shape
+  if num_bands != len(args.bands):
+    raise ValueError("model expects {} bands, --bands has {}".format(num_bands, len(args.bands)))
+  args.crop = height
+
+# tile sources
+#--------------------------------
+def tile_dataset(filelist, batch_size, bands, crop, manifest, cycle_length, read_buffer_mb, labeled=False):
+  """ Batches of (shard number, record number, image, label) over all records
+  of the shards, once each; the labels are -1 unless labeled. Shards are read
+  in parallel and batches decoded in parallel; every row names its source, so
+  the order they come in does not matter. """
+  crop_dim = train.crop_size(crop)
+  start = (train.IMG_DIM - crop_dim) // 2
+  if manifest is None:
+    features = train.feature_spec(bands)
+    compression = ""
+  else:
+    features = train.repacked_feature_spec()
+    compression = "" if manifest["compression"] == "NONE" else manifest["compression"]
+    channels = [manifest["bands"].index(band) for band in bands]
+  # tiles to score need not be labeled
+  if not labeled:
+    del features['label']
+  filenames = tf.constant(filelist)
+
+  def _records_(shard):
+    records = tf.data.TFRecordDataset(filenames[shard], compression_type=compression,
+                                      buffer_size=read_buffer_mb * 2**20)
+    return records.apply(tf.data.experimental.enumerate_dataset()).map(lambda i, x: (shard, i, x))
+
+  def _decode_batch_(shard, record, serialized_batch):
+    examples = tf.parse_example(serialized_batch, features)
+    if manifest is not None:
+      image = tf.decode_raw(examples['image'], tf.uint8)
+      image = tf.reshape(image, shape=[-1, train.IMG_DIM, train.IMG_DIM, len(manifest["bands"])])
+      image = tf.gather(image[:, start:start + crop_dim, start:start + crop_dim], channels, axis=-1)
+    else:
+      raw = tf.decode_raw(tf.stack([examples[band] for band in bands], axis=1), tf.uint8)
+      cube = tf.reshape(raw[:, :, :train.IMG_DIM**2], shape=(-1, len(bands), train.IMG_DIM, train.IMG_DIM))
+      image = tf.transpose(cube[:, :, start:start + crop_dim, start:start + crop_dim], perm=[0, 2, 3, 1])
+    label = examples['label'] if labeled else tf.fill(tf.shape(record), tf.constant(-1, tf.int64))
+    return shard, record, image, label
+
+  dataset = tf.data.Dataset.range(len(filelist)).apply(tf.data.experimental.parallel_interleave(
+    _records_, cycle_length=min(cycle_length, len(filelist)), sloppy=True))
+  dataset = dataset.batch(batch_size).map(_decode_batch_, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+  return dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+def tfrecord_batches(model, args, labeled=False):
+  """ (shard paths, generator of (shard numbers, record numbers, model
+  outputs, labels) batches) for the TFRecords of --split """
+  filelist = sorted(train.file_list_from_folder(args.split, args.data_path))
+  dataset = tile_dataset(filelist, args.batch_size, args.bands, args.crop, shard_index.read_manifest(filelist),
+                         args.cycle_length, args.read_buffer_mb, labeled)
+  shard, record, images, labels = dataset.make_one_shot_iterator().get_next()
+  outputs = model(tf.cast(images, tf.float32))
+  sess = tf.keras.backend.get_session()
+
+  def batches():
+    while True:
+      try:
+        yield sess.run([shard, record, outputs, labels])
+      except tf.errors.OutOfRangeError:
+        return
+  return filelist, batches()
+
+def array_batches(model, args):
+  """ Same as tfrecord_batches for the convert_data.py arrays of --split """
+  # class indices are read per batch rather than one-hot encoded up front
+  images, labels = train.load_cached_data(args.cache_dir, args.split, args.bands, one_hot=False)
+  images = train.center_crop(images, args.crop)
+  with open(os.path.join(args.cache_dir, args.split + "_index.json")) as f:
+    shards = json.load(f)["shards"]
+  starts = np.array([s["start"] for s in shards])
+
+  def batches():
+    for first in range(0, len(images), args.batch_size):
+      rows = np.arange(first, min(first + args.batch_size, len(images)))
+      shard = np.searchsorted(starts, rows, side="right") - 1
+      outputs = model.predict_on_batch(np.asarray(images[rows[0]:rows[-1] + 1], dtype=np.float32))
+      yield shard, rows - starts[shard], outputs, np.asarray(labels[rows[0]:rows[-1] + 1], dtype=np.int64)
+  return [s["path"] for s in shards], batches()
+
+def predict(args):
+  model, classification = load_model(args)
+  check_input_shape(model, args)
+  if args.cache_dir:
+    shards, batches = array_batches(model, args)
+  else:
+    shards, batches = tfrecord_batches(model, args)
+
+  dtypes = {"shard": np.int32, "record": np.int64}
+  if classification:
+    dtypes.update(("prob_{}".format(c), np.float32) for c in range(train.NUM_CLASSES))
+  else:
+    dtypes["score"] = np.float32
+  dtypes["predicted_cows"] = np.uint8
+  metadata = {"model": args.model, "bands": args.bands, "crop": args.crop, "shards": shards}
+  writer = (ParquetWriter if args.format == "parquet" else ColumnWriter)(args.output, dtypes, metadata)
+
+  num_tiles = 0
+  start = time.time()
+  try:
+    for i, (shard, record, outputs, _) in enumerate(batches):
+      batch = {"shard": shard, "record": record}
+      if classification:
+        for c in range(train.NUM_CLASSES):
+          batch["prob_{}".format(c)] = outputs[:, c]
+      else:
+        batch["score"] = outputs[:, 0]
+      batch["predicted_cows"] = predicted_cows(outputs, classification)
+      writer.write(batch)
+      num_tiles += len(record)
+      if (i + 1) % args.log_every == 0:
+        print("{} tiles, {:.1f} tiles/sec".format(num_tiles, num_tiles / (time.time() - start)))
+  finally:
+    writer.close()
+  elapsed = time.time() - start
+  print("scored {} tiles in {:.1f}s ({:.1f} tiles/sec), written to {}".format(
+    num_tiles, elapsed, num_tiles / max(elapsed, 1e-6), args.output))
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument(
+    "model",
+    type=str,
+    help="train.py model (.h5) or tensorflow_train.py --model_dir")
+  parser.add_argument(
+    "-d",
+    "--data_path",
+    type=str,
+    default=DATA_PATH,
+    help="Path to data, containing the --split folder of part-* TFRecords")
+  parser.add_argument(
+    "-c",
+    "--cache_dir",
+    type=str,
+    default="",
+    help="Score the memory-mapped arrays written by convert_data.py instead of TFRecords")
+  parser.add_argument(
+    "--split",
+    type=str,
+    default=SPLIT,
+    help="Data folder (or cached split) to score")
+  parser.add_argument(
+    "-o",
+    "--output",
+    type=str,
+    default=OUTPUT,
+    help="Output directory (columns) or file (parquet)")
+  parser.add_argument(
+    "--format",
+    choices=["columns", "parquet"],
+    default=FORMAT,
+    help="Output format; parquet needs pyarrow")
+  parser.add_argument(
+    "-b",
+    "--batch_size",
+    type=int,
+    default=BATCH_SIZE,
+    help="Number of tiles per prediction batch")
+  parser.add_argument(
+    "--bands",
+    nargs="+",
+    choices=train.ALL_BANDS,
+    default=train.BANDS,
+    help="Spectral bands the model was trained on (tensorflow_train.py uses B2-B11)")
+  parser.add_argument(
+    "--cycle_length",
+    type=int,
+    default=CYCLE_LENGTH,
+    help="Number of shards read in parallel")
+  parser.add_argument(
+    "--read_buffer_mb",
+    type=int,
+    default=READ_BUFFER_MB,
+    help="Read buffer size in MB for each shard")
+  parser.add_argument(
+    "--l1_size",
+    type=int,
+    default=tensorflow_train.L1_SIZE,
+    help="Size of the first conv layer of a tensorflow_train.py model")
+  parser.add_argument(
+    "--l2_size",
+    type=int,
+    default=tensorflow_train.L2_SIZE,
+    help="Size of the second conv layer of a tensorflow_train.py model")
+  parser.add_argument(
+    "--fc_size",
+    type=int,
+    default=tensorflow_train.FC_SIZE,
+    help="Size of the dense layer of a tensorflow_train.py model")
+  parser.add_argument(
+    "--band_stats",
+    type=str,
+    default=tensorflow_train.BAND_STATS,
+    help="Stats file a tensorflow_train.py model was trained with (train.py models record their own)")
+  parser.add_argument(
+    "--crop",
+    type=int,
+    default=train.CROP,
+    help="Center crop of a tensorflow_train.py model (train.py models record their own)")
+  parser.add_argument(
+    "--log_every",
+    type=int,
+    default=LOG_EVERY,
+    help="Batches between progress reports")
+  args = parser.parse_args()
+
+  predict(args)
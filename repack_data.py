@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+# repack_data.py
+# --------------------
+# Rewrite the train/val TFRecords into a compact format: fewer, larger,
+# evenly sized shards in which every example holds a single pre-concatenated
+# 65x65xbands uint8 image (HWC, trimmed to the 65x65 payload) plus its label
+# and, when the source examples carry one, the survey key survey_join.py
+# joins on, optionally ZLIB or GZIP compressed. Each output folder gets a manifest
+# describing the format, which train.py and tensorflow_train.py detect so
+# they read the repacked shards with a single decode per example, and a
+# prebuilt shard index so the shards never need to be re-indexed.
+# Train on the result by pointing --data_path at the output directory.
+
+import argparse
+import json
+import math
+import os
+import tensorflow as tf
+
+import shard_index
+import survey_join
+from convert_data import example_to_arrays
+from train import ALL_BANDS, IMG_DIM, file_list_from_folder
+
+DATA_PATH = "data"
+OUTPUT_PATH = "data_repacked"
+SPLITS = ["train", "val"]
+SHARD_SIZE_MB = 256
+COMPRESSION = "NONE"
+
+def repacked_example(image, label, key_feature=None, key=None):
+  feature = {
+    'image': tf.train.Feature(bytes_list=tf.train.BytesList(value=[image.tobytes()])),
+    'label': tf.train.Feature(int64_list=tf.train.Int64List(value=[label])),
+  }
+  if key_feature is not None:
+    feature[key_feature] = tf.train.Feature(bytes_list=tf.train.BytesList(value=[key]))
+  return tf.train.Example(features=tf.train.Features(feature=feature)).SerializeToString()
+
+def clear_output(folder, overwrite):
+  """ Remove the shards and sidecars of an earlier repack from folder with
+  overwrite, otherwise refuse to write there: stale shards beyond the new
+  shard count would be read along with the new ones """
+  stale = [f for f in os.listdir(folder) if f.startswith('part-') or
+           f in [shard_index.INDEX_FILENAME, shard_index.MANIFEST_FILENAME, survey_join.JOIN_FILENAME]]
+  if not stale:
+    return
+  if not overwrite:
+    raise IOError("{} already holds {} repacked file(s); pass --overwrite to replace them".format(folder, len(stale)))
+  print("removing {} file(s) of an earlier repack from {}".format(len(stale), folder))
+  for filename in stale:
+    os.remove(os.path.join(folder, filename))
+
+def repack_split(split, args):
+  filelist = sorted(file_list_from_folder(split, args.data_path))
+  num_images = shard_index.num_records(shard_index.load_index(filelist))
+  # spread the images evenly over as many shards as the target size needs
+  image_mb = IMG_DIM**2 * len(args.bands) / float(2**20)
+  num_shards = max(1, int(math.ceil(num_images * image_mb / args.shard_size_mb)))
+  shard_counts = [num_images // num_shards + (1 if i < num_images % num_shards else 0)
+                  for i in range(num_shards)]
+  print("{}: repacking {} images into {} shards".format(split, num_images, num_shards))
+
+  output_folder = os.path.join(args.output_path, split)
+  if not os.path.isdir(output_folder):
+    os.makedirs(output_folder)
+  clear_output(output_folder, args.overwrite)
+  options = tf.python_io.TFRecordOptions(
+    getattr(tf.python_io.TFRecordCompressionType, args.compression))
+  # carry the survey key through if the source examples have one
+  key_feature = args.key_feature if args.key_feature in (survey_join.first_example_features(filelist) or []) else None
+
+  def records():
+    for path in filelist:
+      for _, serialized_example in shard_index.read_records(path):
+        image, label = example_to_arrays(serialized_example, args.bands)
+        key = None
+        if key_feature is not None:
+          key = tf.train.Example.FromString(serialized_example).features.feature[key_feature].bytes_list.value[0]
+        yield image, label, key
+
+  index = {}
+  source = records()
+  for shard, count in enumerate(shard_counts):
+    filename = "part-{:05d}".format(shard)
+    offsets = []
+    offset = 0
+    label_counts = {}
+    with tf.python_io.TFRecordWriter(os.path.join(output_folder, filename), options=options) as writer:
+      for _ in range(count):
+        image, label, key = next(source)
+        record = repacked_example(image, label, key_feature, key)
+        writer.write(record)
+        offsets.append(offset)
+        offset += shard_index.RECORD_HEADER_SIZE + len(record) + shard_index.RECORD_FOOTER_SIZE
+        label_counts[str(label)] = label_counts.get(str(label), 0) + 1
+    stat = os.stat(os.path.join(output_folder, filename))
+    index[filename] = {
+      "size": stat.st_size,
+      "mtime": stat.st_mtime,
+      "count": count,
+      # byte offsets are only meaningful in uncompressed shards
+      "offsets": offsets if args.compression == "NONE" else [],
+      "label_counts": label_counts
+    }
+
+  shard_index.write_index(output_folder, index)
+  manifest = {
+    "format": shard_index.REPACKED_FORMAT,
+    "bands": args.bands,
+    "img_dim": IMG_DIM,
+    "compression": args.compression,
+    "key_feature": key_feature
+  }
+  with open(os.path.join(output_folder, shard_index.MANIFEST_FILENAME), "w") as f:
+    json.dump(manifest, f, indent=2)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument(
+    "-d",
+    "--data_path",
+    type=str,
+    default=DATA_PATH,
+    help="Path to data, containing train/ and val/")
+  parser.add_argument(
+    "-o",
+    "--output_path",
+    type=str,
+    default=OUTPUT_PATH,
+    help="Output path for the repacked train/ and val/ folders")
+  parser.add_argument(
+    "--bands",
+    nargs="+",
+    choices=ALL_BANDS,
+    default=ALL_BANDS,
+    help="Spectral bands to keep (training can use any subset of these)")
+  parser.add_argument(
+    "--overwrite",
+    action="store_true",
+    help="Replace the shards of an earlier repack in the output folders")
+  parser.add_argument(
+    "--key_feature",
+    type=str,
+    default=survey_join.KEY_FEATURE,
+    help="Bytes feature holding the survey uuid, copied into the repacked examples when present")
+  parser.add_argument(
+    "--splits",
+    nargs="+",
+    default=SPLITS,
+    help="Data folders to repack")
+  parser.add_argument(
+    "--shard_size_mb",
+    type=int,
+    default=SHARD_SIZE_MB,
+    help="Target uncompressed size of each output shard in MB")
+  parser.add_argument(
+    "--compression",
+    choices=["NONE", "ZLIB", "GZIP"],
+    default=COMPRESSION,
+    help="Compression of the output shards")
+  args = parser.parse_args()
+
+  for split in args.splits:
+    repack_split(split, args)
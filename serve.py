@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+
+# serve.py
+# --------------------
+# Serve a trained classification model (a train.py .h5 file) over HTTP on
+# the local machine. POST /predict with a JSON body holding one or many
+# band cubes, either as nested lists of uint8 pixel values
+#   {"instances": [[[[b1, b2, ...], ...], ...], ...]}
+# or as base64-encoded raw uint8 HWC bytes
+#   {"b64": ["...", ...]}
+# returns {"probabilities": [[p0, p1, p2, p3], ...], "predicted_cows": [...]}.
+# Requests are coalesced into micro-batches: a batch is run as soon as it
+# holds --max_batch_size tiles or its first request has waited --max_wait_ms,
+# by a pool of --num_workers threads sharing one TensorFlow session.
+# GET /metrics returns request counts and histograms of request latency,
+# queueing delay and batch size; load_test.py drives the server under
+# concurrency and reports p50/p99 latency.
+
+import argparse
+import base64
+import bisect
+import json
+import os
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import tensorflow as tf
+
+import predict
+
+HOST = "127.0.0.1"
+PORT = 8500
+MAX_BATCH_SIZE = 256
+MAX_WAIT_MS = 5.0
+NUM_WORKERS = 2
+# upper bounds in milliseconds of the latency histogram buckets
+LATENCY_BUCKETS_MS = [0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, float("inf")]
+
+class Histogram(object):
+  """ Counts of observations per bucket, with percentiles estimated as the
+  upper bound of the bucket they fall in, capped at the largest observation
+  (so the overflow bucket reports a finite value that JSON can hold) """
+  def __init__(self, buckets):
+    self.buckets = buckets
+    self.counts = [0] * len(buckets)
+    self.total = 0.0
+    self.max = 0.0
+
+  def observe(self, value):
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.total += value
+    self.max = max(self.max, value)
+
+  def percentile(self, q):
+    count = sum(self.counts)
+    if not count:
+      return 0.0
+    rank = q / 100.0 * count
+    seen = 0
+    for bound, bucket_count in zip(self.buckets, self.counts):
+      seen += bucket_count
+      if seen >= rank:
+        return min(bound, self.max)
+    return self.max
+
+  def summary(self):
+    count = sum(self.counts)
+    return {
+      "count": count,
+      "mean": self.total / count if count else 0.0,
+      "max": self.max,
+      "p50": self.percentile(50),
+      "p99": self.percentile(99),
+      "buckets": [[str(bound), bucket_count] for bound, bucket_count in zip(self.buckets, self.counts)]
+    }
+
+class Metrics(object):
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.latency_ms = Histogram(LATENCY_BUCKETS_MS)
+    self.queue_ms = Histogram(LATENCY_BUCKETS_MS)
+    self.batch_size = Histogram([2**i for i in range(12)] + [float("inf")])
+    self.requests = 0
+    self.tiles = 0
+    self.errors = 0
+
+  def record_batch(self, size, queue_ms):
+    with self.lock:
+      self.batch_size.observe(size)
+      for wait in queue_ms:
+        self.queue_ms.observe(wait)
+
+  def record_request(self, tiles, latency_ms):
+    with self.lock:
+      self.requests += 1
+      self.tiles += tiles
+      self.latency_ms.observe(latency_ms)
+
+  def record_error(self):
+    with self.lock:
+      self.errors += 1
+
+  def summary(self):
+    with self.lock:
+      return {
+        "requests": self.requests,
+        "tiles": self.tiles,
+        "errors": self.errors,
+        "latency_ms": self.latency_ms.summary(),
+        "queue_ms": self.queue_ms.summary(),
+        "batch_size": self.batch_size.summary()
+      }
+
+class PendingRequest(object):
+  """ Tiles of one HTTP request waiting for their probabilities """
+  def __init__(self, images):
+    self.images = images
+    self.arrival = time.time()
+    self.done = threading.Event()
+    self.probabilities = None
+    self.error = None
+
+class MicroBatcher(object):
+  """ Coalesces pending requests into batches of at most max_batch_size
+  tiles, each run once full or once its oldest request has waited
+  max_wait_ms, by num_workers threads """
+  def __init__(self, model, max_batch_size, max_wait_ms, num_workers, metrics):
+    self.sess = tf.keras.backend.get_session()
+    self.images = tf.placeholder(tf.uint8, shape=(None,) + tuple(model.input_shape[1:]))
+    self.probabilities = model(tf.cast(self.images, tf.float32))
+    self.input_shape = tuple(model.input_shape[1:])
+    self.max_batch_size = max_batch_size
+    self.max_wait = max_wait_ms / 1000.0
+    self.metrics = metrics
+    self.pending = queue.Queue()
+    # one worker at a time assembles a batch so requests are not split
+    # between half-empty batches
+    self.assembling = threading.Lock()
+    self.workers = [threading.Thread(target=self._work, daemon=True) for _ in range(num_workers)]
+    for worker in self.workers:
+      worker.start()
+
+  def predict(self, images):
+    request = PendingRequest(images)
+    self.pending.put(request)
+    request.done.wait()
+    if request.error is not None:
+      raise request.error
+    return request.probabilities
+
+  def _next_batch(self):
+    with self.assembling:
+      batch = [self.pending.get()]
+      size = len(batch[0].images)
+      deadline = batch[0].arrival + self.max_wait
+      while size < self.max_batch_size:
+        timeout = deadline - time.time()
+        if timeout <= 0:
+          break
+        try:
+          request = self.pending.get(timeout=timeout)
+        except queue.Empty:
+          break
+        batch.append(request)
+        size += len(request.images)
+      return batch
+
+  def _work(self):
+    while True:
+      batch = self._next_batch()
+      start = time.time()
+      try:
+        probabilities = self.sess.run(self.probabilities,
+                                      {self.images: np.concatenate([r.images for r in batch])})
+      except Exception as e:
+        for request in batch:
+          request.error = e
+          request.done.set()
+        continue
+      self.metrics.record_batch(len(probabilities), [1000 * (start - r.arrival) for r in batch])
+      offset = 0
+      for request in batch:
+        request.probabilities = probabilities[offset:offset + len(request.images)]
+        offset += len(request.images)
+        request.done.set()
+
+def decode_images(body, input_shape):
+  """ uint8 array of tiles from a /predict request body """
+  if "b64" in body:
+    raw = [np.frombuffer(base64.b64decode(tile), dtype=np.uint8) for tile in body["b64"]]
+    images = np.stack([tile.reshape(input_shape) for tile in raw])
+  else:
+    images = np.asarray(body["instances"], dtype=np.uint8)
+  if images.ndim != 4 or images.shape[1:] != input_shape:
+    raise ValueError("expected tiles of shape {}, got {}".format(input_shape, images.shape[1:]))
+  return images
+
+def make_handler(batcher, metrics):
+  class PredictionHandler(BaseHTTPRequestHandler):
+    def _reply(self, status, payload):
+      body = json.dumps(payload).encode("utf-8")
+      self.send_response(status)
+      self.send_header("Content-Type", "application/json")
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def do_GET(self):
+      if self.path == "/metrics":
+        self._reply(200, metrics.summary())
+      elif self.path == "/healthz":
+        self._reply(200, {"status": "ok"})
+      else:
+        self._reply(404, {"error": "not found"})
+
+    def do_POST(self):
+      if self.path != "/predict":
+        self._reply(404, {"error": "not found"})
+        return
+      start = time.time()
+      try:
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])).decode("utf-8"))
+        images = decode_images(body, batcher.input_shape)
+      except (KeyError, TypeError, ValueError) as e:
+        metrics.record_error()
+        self._reply(400, {"error": str(e)})
+        return
+      try:
+        probabilities = batcher.predict(images)
+      except Exception as e:
+        metrics.record_error()
+        self._reply(500, {"error": str(e)})
+        return
+      self._reply(200, {
+        "probabilities": probabilities.tolist(),
+        "predicted_cows": np.argmax(probabilities, axis=1).tolist()
+      })
+      metrics.record_request(len(images), 1000 * (time.time() - start))
+
+    def log_message(self, format, *args):
+      # per-request logging would dominate the cost of small requests
+      pass
+  return PredictionHandler
+
+def serve(args):
+  if os.path.isdir(args.model):
+    raise ValueError("serve.py takes a train.py .h5 model, not a model directory")
+  model, classification = predict.load_model(args)
+  if not classification:
+    raise ValueError("{} is not a classification model from train.py".format(args.model))
+  if isinstance(model.input_shape, list):
+    raise ValueError("model takes survey features as well (train.py --tabular); only image models are supported")
+  metrics = Metrics()
+  batcher = MicroBatcher(model, args.max_batch_size, args.max_wait_ms, args.num_workers, metrics)
+  server = ThreadingHTTPServer((args.host, args.port), make_handler(batcher, metrics))
+  print("serving {} on http://{}:{}/predict".format(args.model, args.host, args.port))
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument(
+    "model",
+    type=str,
+    help="train.py classification model (.h5)")
+  parser.add_argument(
+    "--host",
+    type=str,
+    default=HOST,
+    help="Address to listen on")
+  parser.add_argument(
+    "--port",
+    type=int,
+    default=PORT,
+    help="Port to listen on")
+  parser.add_argument(
+    "--max_batch_size",
+    type=int,
+    default=MAX_BATCH_SIZE,
+    help="Largest number of tiles run as one batch")
+  parser.add_argument(
+    "--max_wait_ms",
+    type=float,
+    default=MAX_WAIT_MS,
+    help="Longest a request waits for others to join its batch")
+  parser.add_argument(
+    "--num_workers",
+    type=int,
+    default=NUM_WORKERS,
+    help="Number of threads running batches concurrently")
+  args = parser.parse_args()
+
+  serve(args)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+# shard_index.py
+# --------------------
+# Index the part-* TFRecord shards of a data folder: per-shard record counts,
+# byte offsets of each record and label histograms. The index is saved as a
+# small sidecar file next to the shards and reused on later runs; a shard is
+# only re-indexed when its size or modification time changes. The training
+# scripts derive steps per epoch, shuffle buffer sizes and class weights from
+# it instead of hard-coded image counts.
+
+import argparse
+import json
+import multiprocessing
+import os
+import struct
+import tempfile
+import tensorflow as tf
+
+INDEX_FILENAME = ".shard_index.json"
+# folders written by repack_data.py describe their format in a manifest
+MANIFEST_FILENAME = "repacked.json"
+REPACKED_FORMAT = "hwc"
+
+# TFRecord framing: uint64 length, uint32 length crc, data, uint32 data crc
+RECORD_HEADER_SIZE = 12
+RECORD_FOOTER_SIZE = 4
+
+def read_records(path):
+  """ Yield (byte offset, serialized record) for every record in a shard """
+  with open(path, "rb") as f:
+    offset = 0
+    while True:
+      header = f.read(RECORD_HEADER_SIZE)
+      if not header:
+        return
+      if len(header) < RECORD_HEADER_SIZE:
+        raise IOError("truncated record header at byte {} of {}".format(offset, path))
+      length = struct.unpack("<Q", header[:8])[0]
+      data = f.read(length)
+      f.read(RECORD_FOOTER_SIZE)
+      if len(data) < length:
+        raise IOError("truncated record at byte {} of {}".format(offset, path))
+      yield offset, data
+      offset += RECORD_HEADER_SIZE + length + RECORD_FOOTER_SIZE
+
+def shard_records(path, compression="NONE"):
+  """ read_records for a shard with the given repack_data.py compression:
+  compressed shards are decompressed by tf_record_iterator and their byte
+  offsets, which would point into the compressed stream, are None """
+  if compression == "NONE":
+    for offset, data in read_records(path):
+      yield offset, data
+    return
+  options = tf.python_io.TFRecordOptions(getattr(tf.python_io.TFRecordCompressionType, compression))
+  for data in tf.python_io.tf_record_iterator(path, options):
+    yield None, data
+
+def index_shard(task):
+  path, compression = task
+  offsets = []
+  count = 0
+  label_counts = {}
+  for offset, data in shard_records(path, compression):
+    count += 1
+    if offset is not None:
+      offsets.append(offset)
+    label = tf.train.Example.FromString(data).features.feature['label'].int64_list.value[0]
+    label_counts[str(label)] = label_counts.get(str(label), 0) + 1
+  stat = os.stat(path)
+  return {
+    "size": stat.st_size,
+    "mtime": stat.st_mtime,
+    "count": count,
+    # byte offsets are only meaningful in uncompressed shards
+    "offsets": offsets,
+    "label_counts": label_counts
+  }
+
+def read_manifest(filelist):
+  """ The repack_data.py manifest of the folder holding these shards, or
+  None for shards in the original one-feature-per-band format """
+  folders = set(os.path.dirname(path) for path in filelist)
+  manifests = []
+  for folder in folders:
+    manifest_path = os.path.join(folder, MANIFEST_FILENAME)
+    if os.path.exists(manifest_path):
+      with open(manifest_path) as f:
+        manifests.append(json.load(f))
+  if not manifests:
+    return None
+  if len(manifests) != len(folders) or any(m != manifests[0] for m in manifests):
+    raise ValueError("shards in {} do not all share one format".format(sorted(folders)))
+  return manifests[0]
+
+def _is_current(entry, path):
+  stat = os.stat(path)
+  return entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime
+
+def write_index(folder, entries):
+  """ Save {shard filename: index entry} as the index of folder. The index is
+  written to a temporary file and renamed over the old one, so processes
+  loading it concurrently never see a partial file. """
+  fd, partial_path = tempfile.mkstemp(prefix=INDEX_FILENAME, suffix=".partial", dir=folder)
+  try:
+    with os.fdopen(fd, "w") as f:
+      json.dump(entries, f)
+    os.replace(partial_path, os.path.join(folder, INDEX_FILENAME))
+  except BaseException:
+    os.remove(partial_path)
+    raise
+
+def load_index(filelist, num_workers=None):
+  """ Return {shard path: index entry} for the given shards, re-indexing
+  (in parallel across shards) only those that are new or have changed """
+  index = {}
+  for folder in sorted(set(os.path.dirname(path) for path in filelist)):
+    index_path = os.path.join(folder, INDEX_FILENAME)
+    cached = {}
+    if os.path.exists(index_path):
+      with open(index_path) as f:
+        cached = json.load(f)
+    shards = [path for path in filelist if os.path.dirname(path) == folder]
+    stale = [path for path in shards if not _is_current(cached.get(os.path.basename(path)), path)]
+    if stale:
+      manifest = read_manifest(shards)
+      compression = "NONE" if manifest is None else manifest["compression"]
+      print("indexing {} shard(s) in {}".format(len(stale), folder))
+      pool = multiprocessing.Pool(min(num_workers or multiprocessing.cpu_count(), len(stale)))
+      try:
+        tasks = [(path, compression) for path in stale]
+        for path, entry in zip(stale, pool.map(index_shard, tasks)):
+          cached[os.path.basename(path)] = entry
+      finally:
+        pool.close()
+        pool.join()
+      try:
+        write_index(folder, cached)
+      except (IOError, OSError) as e:
+        print("could not save shard index to {}: {}".format(index_path, e))
+    for path in shards:
+      index[path] = cached[os.path.basename(path)]
+  return index
+
+def num_records(index):
+  return sum(entry["count"] for entry in index.values())
+
+def mean_record_size(index):
+  """ Average size in bytes of a serialized record """
+  return float(sum(entry["size"] for entry in index.values())) / max(num_records(index), 1)
+
+def shuffle_buffer_size(index, memory_mb, example_bytes):
+  """ Number of examples of example_bytes each that fit in a shuffle buffer
+  of memory_mb, capped at the size of the dataset """
+  return int(max(1, min(num_records(index), memory_mb * 2**20 // example_bytes)))
+
+def label_counts(index, num_classes):
+  counts = [0] * num_classes
+  for entry in index.values():
+    for label, count in entry["label_counts"].items():
+      counts[int(label)] += count
+  return counts
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument(
+    "folders",
+    nargs="+",
+    help="Data folders containing part-* TFRecord shards")
+  parser.add_argument(
+    "-j",
+    "--num_workers",
+    type=int,
+    default=multiprocessing.cpu_count(),
+    help="Number of shards to index in parallel")
+  args = parser.parse_args()
+
+  for folder in args.folders:
+    filelist = [os.path.join(folder, f) for f in os.listdir(folder)
+                if f.startswith('part-') and not f.endswith('gstmp')]
+    index = load_index(filelist, args.num_workers)
+    print("{}: {} records in {} shards".format(folder, num_records(index), len(index)))
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+# survey_data.py
+# --------------------
+# Typed, columnar loader for extra_data.csv, the ground-level survey export
+# behind the labels (one row per survey submission). The CSV is parsed once
+# with an explicit type per column and saved as a NumPy .npz cache next to
+# it; later loads read the cache instead of re-parsing text, and it is
+# rebuilt whenever the CSV changes. load() returns {column name: array}:
+#   timestamps (SubmissionDate, start, end)   datetime64[m], NaT if missing
+#   measurements (altitude, accuracy,         float32, NaN if missing
+#                 water_points)
+#   single-choice answers (Screen1a, ...,     int8, -1 if missing
+#                 CarryingCapacity)
+#   multi-select answers (Screen1c, Screen2c, split into one int8 column per
+#                 Screen3c, Screen8)          option, <column>_<option>: 1 if
+#                                             selected, 0 if not, -1 if the
+#                                             question was not answered
+#   identifiers (meta-instanceID, KEY,        fixed-width unicode strings
+#                device_id, image)
+
+import argparse
+import csv
+import datetime
+import json
+import os
+import time
+import numpy as np
+
+CSV_PATH = "extra_data.csv"
+# bump whenever the parsed columns change, so stale caches are rebuilt
+SCHEMA_VERSION = 1
+META_KEY = "__meta__"
+
+TIMESTAMP_COLUMNS = ["SubmissionDate", "start", "end"]
+TIMESTAMP_FORMAT = "%m/%d/%y %H:%M"
+FLOAT_COLUMNS = ["my_geopoint-Altitude", "my_geopoint-Accuracy", "water_points"]
+CATEGORY_COLUMNS = ["Screen1a", "Screen1b", "Screen2a", "Screen2b", "Screen3a", "Screen3b", "CarryingCapacity"]
+MULTI_SELECT_COLUMNS = ["Screen1c", "Screen2c", "Screen3c", "Screen8"]
+# answers of the multi-select questions are space-separated option numbers
+MULTI_SELECT_OPTIONS = [0, 1, 2, 3]
+STRING_COLUMNS = ["meta-instanceID", "KEY", "device_id", "image"]
+
+# model features derived from the survey (see tabular_features)
+NUMERIC_FEATURES = ["my_geopoint-Altitude", "my_geopoint-Accuracy", "water_points"]
+TABULAR_FEATURES = (["altitude", "log_accuracy", "water_points"] +
+                    ["month_{}".format(month) for month in range(1, 13)] + ["missing"])
+
+def cache_path(csv_path):
+  return os.path.splitext(csv_path)[0] + ".npz"
+
+def parse_timestamps(values):
+  # submissions cluster on a few thousand distinct minutes, so each distinct
+  # string is parsed once
+  parsed = {"": np.datetime64("NaT", "m")}
+  for value in set(values):
+    if value not in parsed:
+      parsed[value] = np.datetime64(datetime.datetime.strptime(value, TIMESTAMP_FORMAT), "m")
+  return np.array([parsed[value] for value in values], dtype="datetime64[m]")
+
+def parse_floats(values):
+  return np.array([float(value) if value else np.nan for value in values], dtype=np.float32)
+
+def parse_categories(values):
+  return np.array([int(value) if value else -1 for value in values], dtype=np.int8)
+
+def parse_multi_select(values):
+  """ {option: int8 flags} for a column of space-separated selections """
+  flags = np.zeros((len(values), len(MULTI_SELECT_OPTIONS)), dtype=np.int8)
+  for row, value in enumerate(values):
+    if not value:
+      flags[row] = -1
+      continue
+    for option in value.split():
+      flags[row, MULTI_SELECT_OPTIONS.index(int(option))] = 1
+  return {option: flags[:, i] for i, option in enumerate(MULTI_SELECT_OPTIONS)}
+
+def parse_csv(csv_path):
+  with open(csv_path, newline="") as f:
+    reader = csv.reader(f)
+    header = next(reader)
+    rows = list(reader)
+  raw = {name: [row[i] for row in rows] for i, name in enumerate(header)}
+  columns = {}
+  for name in header:
+    if name in TIMESTAMP_COLUMNS:
+      columns[name] = parse_timestamps(raw[name])
+    elif name in FLOAT_COLUMNS:
+      columns[name] = parse_floats(raw[name])
+    elif name in CATEGORY_COLUMNS:
+      columns[name] = parse_categories(raw[name])
+    elif name in MULTI_SELECT_COLUMNS:
+      for option, flags in parse_multi_select(raw[name]).items():
+        columns["{}_{}".format(name, option)] = flags
+    elif name in STRING_COLUMNS:
+      columns[name] = np.array(raw[name], dtype=str)
+    else:
+      raise ValueError("no type for column {} of {}".format(name, csv_path))
+  return columns
+
+def _source_meta(csv_path):
+  stat = os.stat(csv_path)
+  return {"size": stat.st_size, "mtime": stat.st_mtime, "version": SCHEMA_VERSION}
+
+def load(csv_path=CSV_PATH, rebuild=False):
+  """ {column name: array} for the survey CSV, from its .npz cache when that
+  is current """
+  path = cache_path(csv_path)
+  meta = _source_meta(csv_path)
+  if not rebuild and os.path.exists(path):
+    with np.load(path) as cache:
+      if json.loads(str(cache[META_KEY])) == meta:
+        return {name: cache[name] for name in cache.files if name != META_KEY}
+  columns = parse_csv(csv_path)
+  try:
+    # uncompressed, so reloads are a plain read; no object arrays, so no pickle
+    np.savez(path, **dict(columns, **{META_KEY: np.array(json.dumps(meta))}))
+  except (IOError, OSError) as e:
+    print("could not save survey cache to {}: {}".format(path, e))
+  return columns
+
+def tabular_features(columns):
+  """ float32 array of TABULAR_FEATURES per survey row: altitude, log GPS
+  accuracy and water_points clipped to their 1st-99th percentiles and
+  standardized, the submission month one-hot encoded, and a flag for rows
+  missing any of them, whose missing values are 0 (the mean) """
+  numeric = np.stack([columns[name].astype(np.float64) for name in NUMERIC_FEATURES], axis=1)
+  # accuracy is reported in meters and spans three orders of magnitude
+  numeric[:, 1] = np.log1p(numeric[:, 1])
+  low, high = np.nanpercentile(numeric, [1, 99], axis=0)
+  numeric = np.clip(numeric, low, high)
+  numeric = (numeric - np.nanmean(numeric, axis=0)) / np.maximum(np.nanstd(numeric, axis=0), 1e-6)
+  submitted = columns["SubmissionDate"]
+  months = np.zeros((len(submitted), 12))
+  valid = ~np.isnat(submitted)
+  months[np.nonzero(valid)[0], submitted[valid].astype("datetime64[M]").astype(np.int64) % 12] = 1
+  missing = np.isnan(numeric).any(axis=1) | ~valid
+  features = np.concatenate([np.nan_to_num(numeric), months, missing[:, None]], axis=1)
+  return features.astype(np.float32)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument(
+    "--csv_path",
+    type=str,
+    default=CSV_PATH,
+    help="Survey export to load")
+  parser.add_argument(
+    "--rebuild",
+    action="store_true",
+    help="Re-parse the CSV even if the cache is current")
+  args = parser.parse_args()
+
+  start = time.time()
+  columns = load(args.csv_path, args.rebuild)
+  elapsed = time.time() - start
+  num_rows = len(next(iter(columns.values())))
+  print("{} rows, {} columns in {:.2f}s".format(num_rows, len(columns), elapsed))
+  for name, values in columns.items():
+    print("  {:28s} {}".format(name, values.dtype))
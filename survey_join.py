@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+# survey_join.py
+# --------------------
+# Join the TFRecord examples to their survey rows in extra_data.csv. One
+# streaming pass over the part-* shards reads the survey key (KEY /
+# meta-instanceID uuid) stored in every example and records, per shard and
+# in record order, the number of the matching survey row (-1 if none). The
+# join is saved as a sidecar next to the shards, like the shard index, and
+# only rebuilt when a shard, the survey export or the key feature changes.
+# survey_table() and feature_table() turn it into dense float32 tables of
+# raw survey columns or of the normalized model features, indexed by the
+# position of an example in a shard list, which train.py's pipeline gathers
+# a whole batch at a time (--survey_columns, --tabular).
+#
+# The examples must carry the survey key as a bytes feature (--key_feature).
+# Nothing else in a record (the bands and the label) identifies its survey
+# row, so shards without the key, like the original download, cannot be
+# joined: check_key_feature rejects them up front, naming the features they
+# do carry. repack_data.py copies the key into the repacked shards.
+
+import argparse
+import json
+import os
+import tempfile
+import numpy as np
+import tensorflow as tf
+
+import shard_index
+import survey_data
+
+JOIN_FILENAME = ".survey_join.npz"
+KEY_FEATURE = "KEY"
+META_KEY = "__meta__"
+
+def survey_rows(columns):
+  """ {uuid: row number}; KEY and meta-instanceID hold the same uuid, but
+  either may be what the examples carry """
+  rows = {}
+  for name in ["meta-instanceID", "KEY"]:
+    rows.update((key, row) for row, key in enumerate(columns[name]))
+  return rows
+
+def first_example_features(filelist, compression="NONE"):
+  """ Feature names of the first record in the shards, None if all are
+  empty """
+  for path in sorted(filelist):
+    for _, data in shard_index.shard_records(path, compression):
+      return sorted(tf.train.Example.FromString(data).features.feature.keys())
+  return None
+
+def check_key_feature(filelist, key_feature=KEY_FEATURE):
+  """ Raise a ValueError, before any joining or training starts, if the
+  examples of a folder do not carry key_feature """
+  for folder in sorted(set(os.path.dirname(path) for path in filelist)):
+    shards = [path for path in filelist if os.path.dirname(path) == folder]
+    manifest = shard_index.read_manifest(shards)
+    features = first_example_features(shards, "NONE" if manifest is None else manifest["compression"])
+    if features is not None and key_feature not in features:
+      raise ValueError(
+        "the examples in {} have no '{}' feature to join them to the survey on (they only carry {}). "
+        "Survey columns and the tabular model need shards that store each example's survey uuid; "
+        "set --survey_key_feature if it is stored under another name".format(folder, key_feature, features))
+
+def join_shard(path, key_feature, rows, compression="NONE"):
+  """ int32 survey row of every record in the shard, -1 where the key is
+  not in the survey """
+  joined = []
+  for number, (_, data) in enumerate(shard_index.shard_records(path, compression)):
+    feature = tf.train.Example.FromString(data).features.feature
+    if key_feature not in feature:
+      raise KeyError("record {} of {} has no '{}' feature (features: {})".format(
+        number, path, key_feature, sorted(feature.keys())))
+    key = feature[key_feature].bytes_list.value[0].decode("utf-8")
+    joined.append(rows.get(key, -1))
+  return np.array(joined, dtype=np.int32)
+
+def _shard_meta(path):
+  stat = os.stat(path)
+  return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+def read_join(join_path, source):
+  """ ({shard filename: survey rows}, {shard filename: size and mtime}) of a
+  saved join, empty if there is none or it was made from another source """
+  if not os.path.exists(join_path):
+    return {}, {}
+  with np.load(join_path) as saved:
+    meta = json.loads(str(saved[META_KEY]))
+    if meta["source"] != source:
+      return {}, {}
+    return {name: saved[name] for name in saved.files if name != META_KEY}, meta["shards"]
+
+def write_join(folder, joined, shard_meta, source):
+  """ Save the join of folder, merged with the shards another process saved
+  since it was loaded. The join is written to a temporary file and renamed
+  over the old one, like the shard index, so processes loading it
+  concurrently never see a partial file. """
+  join_path = os.path.join(folder, JOIN_FILENAME)
+  saved, saved_meta = read_join(join_path, source)
+  joined = dict(saved, **joined)
+  shard_meta = dict(saved_meta, **shard_meta)
+  meta = {"source": source, "shards": shard_meta}
+  fd, partial_path = tempfile.mkstemp(prefix=JOIN_FILENAME, suffix=".partial", dir=folder)
+  try:
+    with os.fdopen(fd, "wb") as f:
+      np.savez(f, **dict(joined, **{META_KEY: np.array(json.dumps(meta))}))
+    os.replace(partial_path, join_path)
+  except BaseException:
+    os.remove(partial_path)
+    raise
+
+def load_join(filelist, key_feature=KEY_FEATURE, csv_path=survey_data.CSV_PATH):
+  """ {shard path: int32 survey row per record}, joining only the shards
+  that are new or changed since the saved join """
+  check_key_feature(filelist, key_feature)
+  csv_stat = os.stat(csv_path)
+  source = {"csv_size": csv_stat.st_size, "csv_mtime": csv_stat.st_mtime, "key_feature": key_feature}
+  rows = None
+  join = {}
+  for folder in sorted(set(os.path.dirname(path) for path in filelist)):
+    cached, shard_meta = read_join(os.path.join(folder, JOIN_FILENAME), source)
+    shards = [path for path in filelist if os.path.dirname(path) == folder]
+    stale = [path for path in shards
+             if shard_meta.get(os.path.basename(path)) != _shard_meta(path)]
+    if stale:
+      if rows is None:
+        rows = survey_rows(survey_data.load(csv_path))
+      manifest = shard_index.read_manifest(shards)
+      compression = "NONE" if manifest is None else manifest["compression"]
+      print("joining {} shard(s) in {} to {}".format(len(stale), folder, csv_path))
+      joined = {}
+      for path in stale:
+        joined[os.path.basename(path)] = join_shard(path, key_feature, rows, compression)
+        shard_meta[os.path.basename(path)] = _shard_meta(path)
+      cached.update(joined)
+      try:
+        write_join(folder, joined, {name: shard_meta[name] for name in joined}, source)
+      except (IOError, OSError) as e:
+        print("could not save survey join to {}: {}".format(os.path.join(folder, JOIN_FILENAME), e))
+    for path in shards:
+      join[path] = cached[os.path.basename(path)]
+  return join
+
+def join_table(filelist, values, missing_row, key_feature=KEY_FEATURE, csv_path=survey_data.CSV_PATH):
+  """ (table, offsets): the rows of values (one per survey row) for every
+  example of the shards in filelist order, missing_row where an example has
+  no survey row, and the position of the first example of each shard in the
+  table """
+  join = load_join(filelist, key_feature, csv_path)
+  # survey row -1 picks the appended missing row
+  values = np.concatenate([values, np.asarray(missing_row, dtype=values.dtype)[None]])
+  rows = [join[path] for path in filelist]
+  offsets = np.cumsum([0] + [len(r) for r in rows[:-1]]).astype(np.int64)
+  return values[np.concatenate(rows)], offsets
+
+def survey_table(filelist, columns, key_feature=KEY_FEATURE, csv_path=survey_data.CSV_PATH):
+  """ join_table of the selected survey columns as float32, NaN for
+  examples without a survey row """
+  survey = survey_data.load(csv_path)
+  missing = [name for name in columns if name not in survey]
+  if missing:
+    raise ValueError("survey has no columns {}".format(missing))
+  values = np.stack([survey[name].astype(np.float32) for name in columns], axis=1)
+  return join_table(filelist, values, np.full(len(columns), np.nan), key_feature, csv_path)
+
+def feature_table(filelist, key_feature=KEY_FEATURE, csv_path=survey_data.CSV_PATH):
+  """ join_table of the normalized survey_data.tabular_features, computed
+  once for the whole survey; examples without a survey row only have the
+  missing flag set """
+  values = survey_data.tabular_features(survey_data.load(csv_path))
+  missing_row = np.zeros(len(survey_data.TABULAR_FEATURES))
+  missing_row[survey_data.TABULAR_FEATURES.index("missing")] = 1
+  return join_table(filelist, values, missing_row, key_feature, csv_path)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument(
+    "folders",
+    nargs="+",
+    help="Data folders containing part-* TFRecord shards")
+  parser.add_argument(
+    "--key_feature",
+    type=str,
+    default=KEY_FEATURE,
+    help="Bytes feature of the examples holding the survey uuid")
+  parser.add_argument(
+    "--csv_path",
+    type=str,
+    default=survey_data.CSV_PATH,
+    help="Survey export to join to")
+  args = parser.parse_args()
+
+  for folder in args.folders:
+    filelist = [os.path.join(folder, f) for f in os.listdir(folder)
+                if f.startswith('part-') and not f.endswith('gstmp')]
+    join = load_join(filelist, args.key_feature, args.csv_path)
+    joined = np.concatenate(list(join.values()))
+    print("{}: {} of {} examples joined to a survey row".format(folder, int((joined >= 0).sum()), len(joined)))
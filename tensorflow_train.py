@@ -8,14 +8,19 @@
 # higher forage quality (lower drought severity) 
 
 import argparse
+import glob
+import hashlib
+import json
 import os
 import math
+import time
 import tensorflow as tf
 from tensorflow.keras import layers, initializers
-import wandb
-from wandb.tensorflow import WandbHook
 from tensorflow import set_random_seed
 
+import band_stats
+import shard_index
+
 set_random_seed(1)
 tf.logging.set_verbosity(tf.logging.INFO)
 
@@ -26,6 +31,35 @@ EPOCHS = 10
 L1_SIZE = 32
 L2_SIZE = 64
 FC_SIZE = 128
+# memory budget for each shuffle buffer
+SHUFFLE_MEMORY_MB = 512
+# number of shards read from concurrently
+CYCLE_LENGTH = 16
+# read buffer per shard
+READ_BUFFER_MB = 8
+# device to stage input batches on, e.g. "/gpu:0" (none by default)
+PREFETCH_DEVICE = ""
+# decode cache for multi-epoch runs: none, memory, disk or auto (memory if
+# the decoded examples fit in DECODE_CACHE_MEMORY_MB, disk otherwise)
+DECODE_CACHE = "none"
+DECODE_CACHE_DIR = os.path.join("data", "decode_cache")
+DECODE_CACHE_MEMORY_MB = 4096
+# bump whenever _parse_ changes what a decoded example looks like, so stale
+# decode caches are not reused
+PREPROCESS_VERSION = 1
+ALL_BANDS = ['B1', 'B2', 'B3', 'B4', 'B5', 'B6', 'B7', 'B8', 'B9', 'B10', 'B11']
+BANDS = ['B2', 'B3', 'B4', 'B5', 'B6', 'B7', 'B8', 'B9', 'B10', 'B11']
+# side of the center crop fed to the model (0 keeps the full 65x65 image)
+CROP = 0
+# per-band stats file from band_stats.py to standardize the inputs with
+BAND_STATS = ""
+# checkpoint directory shared by all tasks of a distributed run (empty for a
+# temporary directory)
+MODEL_DIR = ""
+# every how many training steps to trace one for the input-bound fraction,
+# and how many traced steps each logged fraction covers
+INPUT_TRACE_STEPS = 100
+INPUT_TRACE_LOG = 10
 
 # data utils
 #------------------
@@ -42,47 +76,229 @@ def file_list_from_folder(folder, data_path):
       filelist.append(os.path.join(folderpath, filename))
   return filelist
 
-features = {
-  'B1': tf.FixedLenFeature([], tf.string),
-  'B2': tf.FixedLenFeature([], tf.string),
-  'B3': tf.FixedLenFeature([], tf.string),
-  'B4': tf.FixedLenFeature([], tf.string),
-  'B5': tf.FixedLenFeature([], tf.string),
-  'B6': tf.FixedLenFeature([], tf.string),
-  'B7': tf.FixedLenFeature([], tf.string),
-  'B8': tf.FixedLenFeature([], tf.string),
-  'B9': tf.FixedLenFeature([], tf.string),
-  'B10': tf.FixedLenFeature([], tf.string),
-  'B11': tf.FixedLenFeature([], tf.string),
-  'label': tf.FixedLenFeature([], tf.int64),
-}        
-
-def parse_tfrecords(filelist, batch_size, num_epochs):
-  def _parse_(serialized_example, keylist=['B2', 'B3', 'B4', 'B5', 'B6', 'B7', 'B8', 'B9', 'B10', 'B11']):
+# only the requested bands are parsed, so unused bands are never materialized
+def feature_spec(bands):
+  spec = {band: tf.FixedLenFeature([], tf.string) for band in bands}
+  spec['label'] = tf.FixedLenFeature([], tf.int64)
+  return spec
+
+# shards written by repack_data.py hold all bands in a single HWC uint8 image
+def repacked_feature_spec():
+  return {
+    'image': tf.FixedLenFeature([], tf.string),
+    'label': tf.FixedLenFeature([], tf.int64),
+  }
+
+def read_shards(filelist, cycle_length, read_buffer_mb, deterministic, repeat=True, compression=""):
+  # reshuffle the shard order every epoch and read cycle_length shards in
+  # parallel, interleaving their records, so a shuffle buffer much smaller
+  # than the dataset still mixes it well and one slow read does not stall
+  # the pipeline. Non-deterministic mode takes records from whichever shard
+  # is ready first.
+  shard_dataset = tf.data.Dataset.from_tensor_slices(filelist).shuffle(len(filelist))
+  if repeat:
+    shard_dataset = shard_dataset.repeat(-1)
+  return shard_dataset.apply(tf.data.experimental.parallel_interleave(
+    lambda filename: tf.data.TFRecordDataset(filename, compression_type=compression,
+                                             buffer_size=read_buffer_mb * 2**20),
+    cycle_length=min(cycle_length, len(filelist)),
+    sloppy=not deterministic))
+
+def cluster_task():
+  # (input shard index, number of input shards) of this process: the chief
+  # and the workers of a TF_CONFIG cluster each read their own part of the
+  # training shards, a single process or an evaluator reads all of them
+  tf_config = json.loads(os.environ.get("TF_CONFIG", "{}"))
+  cluster = tf_config.get("cluster", {})
+  task = tf_config.get("task", {})
+  num_chiefs = len(cluster.get("chief", []))
+  num_workers = num_chiefs + len(cluster.get("worker", []))
+  if task.get("type") == "chief":
+    return 0, num_workers
+  if task.get("type") == "worker":
+    return num_chiefs + task.get("index", 0), num_workers
+  return 0, 1
+
+def worker_shards(filelist, worker_index, num_workers):
+  # every num_workers-th shard starting at worker_index
+  shards = sorted(filelist)[worker_index::num_workers]
+  if not shards:
+    raise ValueError("{} shards cannot be split over {} workers".format(len(filelist), num_workers))
+  return shards
+
+def build_dataset(filelist, batch_size, num_epochs, buffer_size, bands=BANDS,
+                  cycle_length=CYCLE_LENGTH, read_buffer_mb=READ_BUFFER_MB, deterministic=True,
+                  prefetch_device=None, cache=None, manifest=None, crop=CROP,
+                  worker_index=0, num_workers=1):
+  # cache is None (no cache), "" (cache decoded examples in memory) or the
+  # path prefix of a tf.data cache file for the decoded examples. manifest is
+  # the repack_data.py manifest for shards in the repacked format. crop is the
+  # side of the center crop taken while decoding (0 for the full image).
+  # worker_index and num_workers restrict the input to this worker's shards.
+  filelist = worker_shards(filelist, worker_index, num_workers)
+  crop_dim = crop_size(crop)
+  start = (65 - crop_dim) // 2
+  if manifest is None:
+    features = feature_spec(bands)
+    compression = ""
+  else:
+    features = repacked_feature_spec()
+    compression = "" if manifest["compression"] == "NONE" else manifest["compression"]
+    stored_bands = manifest["bands"]
+    missing = [band for band in bands if band not in stored_bands]
+    if missing:
+      raise ValueError("repacked shards do not contain bands {}".format(missing))
+    channels = [stored_bands.index(band) for band in bands]
+
+  def _parse_(serialized_example, keylist=bands):
     example = tf.parse_single_example(serialized_example, features)
- 
-    def getband(example_key):
-      img = tf.decode_raw(example_key, tf.uint8)
-      return tf.reshape(img[:4225], shape=(65, 65, 1))
- 
-    bandlist = [getband(example[key]) for key in keylist]
-    # combine bands into tensor
-    image = tf.concat(bandlist, -1)
+    if manifest is not None:
+      # decode the whole HWC image at once and pick out the requested bands
+      image = tf.reshape(tf.decode_raw(example['image'], tf.uint8), shape=(65, 65, len(stored_bands)))
+      image = image[start:start + crop_dim, start:start + crop_dim]
+      if channels != list(range(len(stored_bands))):
+        image = tf.gather(image, channels, axis=-1)
+    else:
+      def getband(example_key):
+        img = tf.decode_raw(example_key, tf.uint8)
+        band = tf.reshape(img[:4225], shape=(65, 65, 1))
+        # crop each band before concatenating so only the crop is copied
+        return band[start:start + crop_dim, start:start + crop_dim]
+
+      bandlist = [getband(example[key]) for key in keylist]
+      # combine bands into tensor
+      image = tf.concat(bandlist, -1)
     label = tf.cast(example['label'], tf.int32)
     # divide the label by 3 so it's between 0 and 1
     label = tf.truediv(label, 3)
     return {'image': image}, label
     
-  tfrecord_dataset = tf.data.TFRecordDataset(filelist)
-  tfrecord_dataset = tfrecord_dataset.map(lambda x:_parse_(x)).shuffle(105000).repeat(-1).batch(batch_size)
+  tfrecord_dataset = read_shards(filelist, cycle_length, read_buffer_mb, deterministic,
+                                 repeat=cache is None, compression=compression)
+  if cache is not None:
+    # decode a single pass over the shards into the cache, then shuffle and
+    # repeat the cached examples so later epochs skip parsing entirely
+    tfrecord_dataset = tfrecord_dataset.map(lambda x:_parse_(x)).cache(cache).shuffle(buffer_size).repeat(-1)
+  else:
+    tfrecord_dataset = tfrecord_dataset.map(lambda x:_parse_(x)).shuffle(buffer_size)
+  tfrecord_dataset = tfrecord_dataset.batch(batch_size)
+  # assemble the next batches while the model trains on the current one
+  tfrecord_dataset = tfrecord_dataset.prefetch(tf.data.experimental.AUTOTUNE)
+  if prefetch_device:
+    tfrecord_dataset = tfrecord_dataset.apply(tf.data.experimental.prefetch_to_device(prefetch_device))
+  return tfrecord_dataset
+
+def parse_tfrecords(filelist, batch_size, num_epochs, buffer_size, bands=BANDS, **kwargs):
+  # next batch of build_dataset as tensors, for use outside an Estimator
+  # (whose input_fn returns the dataset itself). A one-shot iterator cannot
+  # capture the prefetch_to_device stage.
+  if kwargs.get("prefetch_device"):
+    raise ValueError("prefetch_device needs the dataset from build_dataset")
+  tfrecord_dataset = build_dataset(filelist, batch_size, num_epochs, buffer_size, bands, **kwargs)
   tfrecord_iterator = tfrecord_dataset.make_one_shot_iterator()
   return tfrecord_iterator.get_next()
 
-def build_estimator_from_model_original(args):
+class InputBoundHook(tf.train.SessionRunHook):
+  # logs the fraction of training time spent waiting for input batches. One
+  # step in every trace_steps is traced, and the time its input get_next op
+  # ran (the wait for a batch, after any prefetch_to_device stage) is
+  # compared with the step's wall time
+  def __init__(self, trace_steps=INPUT_TRACE_STEPS, log_every=INPUT_TRACE_LOG):
+    self.trace_steps = trace_steps
+    self.log_every = log_every
+
+  def begin(self):
+    self.step = 0
+    self.traced = 0
+    self.wait_secs = 0.0
+    self.step_secs = 0.0
+
+  def before_run(self, run_context):
+    self.step += 1
+    if self.step % self.trace_steps:
+      return None
+    self.start = time.time()
+    return tf.train.SessionRunArgs(fetches=tf.train.get_global_step(),
+                                   options=tf.RunOptions(trace_level=tf.RunOptions.SOFTWARE_TRACE))
+
+  def after_run(self, run_context, run_values):
+    if self.step % self.trace_steps:
+      return
+    self.step_secs += time.time() - self.start
+    # the Estimator's input iterator op is IteratorGetNext (possibly suffixed)
+    self.wait_secs += max([node.all_end_rel_micros for device in run_values.run_metadata.step_stats.dev_stats
+                           for node in device.node_stats
+                           if node.node_name.split("/")[-1].startswith("IteratorGetNext")] or [0]) / 1e6
+    self.traced += 1
+    if self.traced % self.log_every == 0:
+      print("input-bound fraction at step {}: {:.3f}".format(run_values.results,
+                                                              self.wait_secs / max(self.step_secs, 1e-6)))
+      self.wait_secs = 0.0
+      self.step_secs = 0.0
+
+def crop_size(crop):
+  # side of the images fed to the model for a --crop setting
+  if crop < 0 or crop > 65:
+    raise ValueError("crop must be between 1 and 65 (or 0 for no crop), got {}".format(crop))
+  return crop or 65
+
+def shuffle_buffer_size(index, args):
+  # size the shuffle buffer of decoded images from the memory budget
+  example_bytes = crop_size(args.crop)**2 * len(args.bands) + 4
+  return shard_index.shuffle_buffer_size(index, args.shuffle_memory_mb, example_bytes)
+
+def clear_stale_cache(prefix):
+  # remove what an interrupted run left of the tf.data cache at prefix: its
+  # lockfile, which would make the next run fail with "cache already in
+  # use", and the partial cache files if the .index (written last) is missing
+  lockfiles = glob.glob(prefix + ".lockfile") + glob.glob(prefix + "_*.lockfile")
+  if not lockfiles:
+    return
+  if os.path.exists(prefix + ".index"):
+    stale = lockfiles
+  else:
+    stale = glob.glob(prefix + ".*") + glob.glob(prefix + "_*")
+  print("removing {} file(s) of an interrupted decode cache at {}".format(len(stale), prefix))
+  for path in stale:
+    os.remove(path)
+
+def decode_cache(filelist, num_examples, args):
+  # tf.data cache for the decoded examples of filelist: None (no cache), ""
+  # (in memory) or a file in args.decode_cache_dir keyed on everything that
+  # determines the decoded examples, so a changed data path or shard, band
+  # selection, feature spec or PREPROCESS_VERSION starts a fresh cache
+  mode = args.decode_cache
+  if mode == "none":
+    return None
+  if mode == "auto":
+    decoded_mb = num_examples * (crop_size(args.crop)**2 * len(args.bands) + 4) / float(2**20)
+    mode = "memory" if decoded_mb <= args.decode_cache_memory_mb else "disk"
+  if mode == "memory":
+    return ""
+  key = json.dumps({
+    # a shard rewritten in place (e.g. by repack_data.py) changes size or mtime
+    "files": sorted([os.path.abspath(path), entry["size"], entry["mtime"]]
+                    for path, entry in shard_index.load_index(filelist).items()),
+    "bands": list(args.bands),
+    "crop": crop_size(args.crop),
+    "features": sorted((name, repr(spec)) for name, spec in feature_spec(args.bands).items()),
+    "format": shard_index.read_manifest(filelist),
+    "version": PREPROCESS_VERSION
+  }, sort_keys=True)
+  if not os.path.isdir(args.decode_cache_dir):
+    os.makedirs(args.decode_cache_dir)
+  prefix = os.path.join(args.decode_cache_dir, "estimator-" + hashlib.sha1(key.encode("utf-8")).hexdigest()[:16])
+  clear_stale_cache(prefix)
+  return prefix
+
+def build_estimator_from_model_original(args, config=None):
   final_bias_init = initializers.Constant(value=0.249)
 
   model = tf.keras.Sequential()
-  model.add(tf.keras.layers.InputLayer(input_shape=[65,65,10], name='image'))
+  model.add(tf.keras.layers.InputLayer(input_shape=[crop_size(args.crop), crop_size(args.crop), len(args.bands)],
+                                     name='image'))
+  if args.band_stats:
+    model.add(band_stats.normalization_layer(args.band_stats, args.bands))
   model.add(layers.Conv2D(filters=6, kernel_size=(5, 5), activation='relu'))
   model.add(layers.AveragePooling2D())
   model.add(layers.Conv2D(filters=16, kernel_size=(5, 5), activation='relu'))
@@ -95,12 +311,17 @@ def build_estimator_from_model_original(args):
   model.compile(loss=tf.keras.losses.mean_squared_error, 
               optimizer=tf.keras.optimizers.Adam(), 
               metrics=['mse'])
-  estimator = tf.keras.estimator.model_to_estimator(keras_model=model)
+  estimator = tf.keras.estimator.model_to_estimator(keras_model=model, config=config)
   return estimator
 
-def build_estimator_from_model_test(args):
+def build_model_test(args):
+  # the Keras model behind build_estimator_from_model_test (also used by
+  # predict.py to restore its checkpoints)
   model = tf.keras.Sequential()
-  model.add(tf.keras.layers.InputLayer(input_shape=[65,65,10], name='image'))
+  model.add(tf.keras.layers.InputLayer(input_shape=[crop_size(args.crop), crop_size(args.crop), len(args.bands)],
+                                     name='image'))
+  if args.band_stats:
+    model.add(band_stats.normalization_layer(args.band_stats, args.bands))
   model.add(layers.Conv2D(filters=args.l1_size, kernel_size=(5, 5), activation='relu'))
   model.add(layers.MaxPooling2D(pool_size=(2, 2)))
   model.add(layers.Conv2D(filters=args.l2_size, kernel_size=(3, 3), activation='relu'))
@@ -112,15 +333,32 @@ def build_estimator_from_model_test(args):
   model.compile(loss=tf.keras.losses.mean_squared_error, 
               optimizer=tf.keras.optimizers.Adam(), 
               metrics=['mse'])
-  estimator = tf.keras.estimator.model_to_estimator(keras_model=model)
+  return model
+
+def build_estimator_from_model_test(args, config=None):
+  estimator = tf.keras.estimator.model_to_estimator(keras_model=build_model_test(args), config=config)
   return estimator
 
 
 def train_cnn(args):
   # load training data
   train, test = load_data(args.data_path)
+  # image counts come from the (cached) shard index
+  train_index = shard_index.load_index(train)
+  test_index = shard_index.load_index(test)
+  num_train = shard_index.num_records(train_index)
+  num_test = shard_index.num_records(test_index)
+  # in a distributed run the chief and every worker train on their own
+  # shards; the evaluator sees the whole test set
+  worker_index, num_workers = cluster_task()
+  train_shards = worker_shards(train, worker_index, num_workers)
+  train_buffer = shuffle_buffer_size({path: train_index[path] for path in train_shards}, args)
+  test_buffer = shuffle_buffer_size(test_index, args)
   
   # initialize wandb logging for your project
+  # (imported here so the models and pipelines can be used without wandb)
+  import wandb
+  from wandb.tensorflow import WandbHook
   wandb.init()
   config={
     "batch_size" : args.batch_size,
@@ -128,17 +366,46 @@ def train_cnn(args):
     "l1_size" : args.l1_size,
     "l2_size" : args.l2_size,
     "fc_size" : args.fc_size,
-    "loss_type" : "mse"
+    "bands" : args.bands,
+    "crop" : args.crop,
+    "loss_type" : "mse",
+    "n_train" : num_train,
+    "n_test" : num_test,
+    "shuffle_buffer" : train_buffer,
+    "decode_cache" : args.decode_cache,
+    "num_workers" : num_workers,
+    "band_stats" : args.band_stats
   }
   wandb.config.update(config)
  
-  estimator = build_estimator_from_model_test(args)
-  max_steps = math.ceil((100000.0 / float (args.batch_size)) * args.epochs)
+  # RunConfig picks up the cluster and this task from TF_CONFIG
+  run_config = tf.estimator.RunConfig(model_dir=args.model_dir or None)
+  estimator = build_estimator_from_model_test(args, run_config)
+  max_steps = math.ceil((float(num_train) / float (args.batch_size)) * args.epochs)
   print("max steps: ", max_steps)
-  train_spec = tf.estimator.TrainSpec(input_fn=lambda: parse_tfrecords(train, args.batch_size, args.epochs),
+  reader_options = {
+    "cycle_length" : args.cycle_length,
+    "read_buffer_mb" : args.read_buffer_mb,
+    "deterministic" : not args.nondeterministic,
+    "crop" : args.crop,
+    "prefetch_device" : args.prefetch_device
+  }
+  train_cache = decode_cache(train_shards, num_train // num_workers, args)
+  test_cache = decode_cache(test, num_test, args)
+  # the input_fns return datasets: the Estimator iterates them with an
+  # initializable iterator, which can capture the prefetch_to_device stage
+  train_spec = tf.estimator.TrainSpec(input_fn=lambda: build_dataset(train, args.batch_size, args.epochs, train_buffer,
+                                                                     args.bands, cache=train_cache,
+                                                                     manifest=shard_index.read_manifest(train),
+                                                                     worker_index=worker_index,
+                                                                     num_workers=num_workers,
+                                                                     **reader_options),
                                       max_steps=max_steps,
-                                      hooks=[WandbHook()])
-  eval_spec = tf.estimator.EvalSpec(input_fn=lambda: parse_tfrecords(test, args.batch_size, 10),
+                                      hooks=[WandbHook(), InputBoundHook()])
+  eval_spec = tf.estimator.EvalSpec(input_fn=lambda: build_dataset(test, args.batch_size, 10, test_buffer,
+                                                                   args.bands, cache=test_cache,
+                                                                   manifest=shard_index.read_manifest(test),
+                                                                   **reader_options),
                                     steps=1000)
   eval_result = tf.estimator.train_and_evaluate(estimator, train_spec, eval_spec)
   print(eval_result)
@@ -184,6 +451,66 @@ if __name__ == "__main__":
     type=int,
     default=FC_SIZE,
     help="size of first fully-connected layer")
+  parser.add_argument(
+    "--bands",
+    nargs="+",
+    choices=ALL_BANDS,
+    default=BANDS,
+    help="Spectral bands to load (sets the number of model input channels)")
+  parser.add_argument(
+    "--crop",
+    type=int,
+    default=CROP,
+    help="Train on a center crop of this size (0 keeps the full image)")
+  parser.add_argument(
+    "--cycle_length",
+    type=int,
+    default=CYCLE_LENGTH,
+    help="Number of shards read in parallel")
+  parser.add_argument(
+    "--read_buffer_mb",
+    type=int,
+    default=READ_BUFFER_MB,
+    help="Read buffer size in MB for each shard")
+  parser.add_argument(
+    "--nondeterministic",
+    action="store_true",
+    help="Take records from whichever shard is ready first (faster, order not reproducible)")
+  parser.add_argument(
+    "--prefetch_device",
+    type=str,
+    default=PREFETCH_DEVICE,
+    help="Device to prefetch input batches to, e.g. /gpu:0 (default: host memory only)")
+  parser.add_argument(
+    "--decode_cache",
+    choices=["none", "memory", "disk", "auto"],
+    default=DECODE_CACHE,
+    help="Cache decoded examples after the first epoch (auto: in memory if they fit, else on disk)")
+  parser.add_argument(
+    "--decode_cache_dir",
+    type=str,
+    default=DECODE_CACHE_DIR,
+    help="Directory for on-disk decode caches")
+  parser.add_argument(
+    "--decode_cache_memory_mb",
+    type=int,
+    default=DECODE_CACHE_MEMORY_MB,
+    help="Largest decoded dataset size in MB that --decode_cache auto keeps in memory")
+  parser.add_argument(
+    "--shuffle_memory_mb",
+    type=int,
+    default=SHUFFLE_MEMORY_MB,
+    help="Memory budget in MB for each shuffle buffer")
+  parser.add_argument(
+    "--band_stats",
+    type=str,
+    default=BAND_STATS,
+    help="Stats file from band_stats.py to standardize each band with inside the model")
+  parser.add_argument(
+    "--model_dir",
+    type=str,
+    default=MODEL_DIR,
+    help="Checkpoint directory, shared by all tasks of a distributed run (see launch_cluster.py --estimator)")
   parser.add_argument(
     "-q",
     "--dry_run",
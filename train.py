@@ -9,32 +9,60 @@
 # thinks the surrounding land could support (0, 1, 2, or 3+)
 
 import argparse
+import glob
+import hashlib
+import json
 import math
 import numpy as np
 import os
+import threading
+import time
 import tensorflow as tf
 from tensorflow.keras import layers, initializers
 
-import wandb
-from wandb.keras import WandbCallback
+import band_stats
+import shard_index
+import survey_data
+import survey_join
 
 tf.compat.v1.set_random_seed(1)
 
 # for categorical classification, there are 4 classes: 0, 1, 2, or 3+ cows
 NUM_CLASSES = 4
-# fixed image counts from TFRecords
-NUM_TRAIN = 86317
-NUM_VAL = 10778
 
 # default image side dimension (65 x 65 square)
 IMG_DIM = 65
-# use 7 out of 10 bands for now
-NUM_BANDS = 7
+# all spectral bands stored in the TFRecords
+ALL_BANDS = ['B1', 'B2', 'B3', 'B4', 'B5', 'B6', 'B7', 'B8', 'B9', 'B10', 'B11']
 
 # settings/hyperparams
 # these defaults can be edited here or overwritten via command line
 MODEL_NAME = ""
+# use 7 out of 10 bands for now
+BANDS = ['B2', 'B3', 'B4', 'B5', 'B6', 'B7', 'B8']
+# side of the center crop fed to the model (0 keeps the full IMG_DIM image)
+CROP = 0
+# random flips and 90 degree rotations of training batches
+AUGMENT = False
+# extra_data.csv survey columns attached to every batch as the 'survey'
+# input (see survey_join.py), and the example feature holding the survey key
+SURVEY_COLUMNS = []
+SURVEY_KEY_FEATURE = survey_join.KEY_FEATURE
+# two-branch classification model: image CNN plus a dense branch over the
+# normalized survey features (survey_data.TABULAR_FEATURES)
+TABULAR = False
+TABULAR_SIZE = 16
+# per-band stats file from band_stats.py; when set, the models standardize
+# each band with it instead of feeding /255 scaled pixels
+BAND_STATS = ""
+# data-parallel training: none, mirrored (all local devices) or multi_worker
+# (one process per worker, configured through TF_CONFIG)
+DISTRIBUTE = "none"
+# compute precision of the classification CNN: float32 or bfloat16 (on CPUs
+# with bfloat16 support)
+PRECISION = "float32"
 DATA_PATH = "data"
+CACHE_DIR = ""
 BATCH_SIZE = 64
 EPOCHS = 10
 L1_SIZE = 32
@@ -46,20 +74,47 @@ DROPOUT_1 = 0.2
 DROPOUT_2 = 0.2
 OPTIMIZER = "Adam"
 LEARNING_RATE = 0.001
+# parse and decode whole batches of TFRecords instead of one example at a time
+BATCHED_DECODE = False
+# memory budget for each shuffle buffer
+SHUFFLE_MEMORY_MB = 512
+# number of shards read from concurrently
+CYCLE_LENGTH = 16
+# read buffer per shard
+READ_BUFFER_MB = 8
+# device to stage input batches on, e.g. "/gpu:0" (none by default)
+PREFETCH_DEVICE = ""
+# tf.data stats tag for time spent waiting on the input pipeline
+INPUT_WAIT_TAG = "input_wait"
+# decode cache for multi-epoch runs: none, memory, disk or auto (memory if
+# the decoded examples fit in DECODE_CACHE_MEMORY_MB, disk otherwise)
+DECODE_CACHE = "none"
+DECODE_CACHE_DIR = os.path.join("data", "decode_cache")
+DECODE_CACHE_MEMORY_MB = 4096
+# bump whenever _parse_ changes what a decoded example looks like, so stale
+# decode caches are not reused
+PREPROCESS_VERSION = 1
+# training checkpoints (weights, optimizer state and training step), written
+# every CHECKPOINT_STEPS steps and at the end of every epoch
+CHECKPOINT_DIR = "checkpoints"
+CHECKPOINT_STEPS = 500
+
+# approximate distribution of ground truth labels in the full dataset,
+# used when the actual label counts are not known:
+# 0: ~60%
+# 1: ~15%
+# 2: ~15%
+# 3: ~10%
+LABEL_DISTRIBUTION = [0.6, 0.15, 0.15, 0.1]
 
-def class_weights_matrix():
-  # define class weights to account for uneven distribution of classes
-  # distribution of ground truth labels:
-  # 0: ~60%
-  # 1: ~15%
-  # 2: ~15%
-  # 3: ~10%
-  class_weights = np.zeros((NUM_TRAIN, NUM_CLASSES))
-  class_weights[:, 0] += 1.0
-  class_weights[:, 1] += 4.0
-  class_weights[:, 2] += 4.0
-  class_weights[:, 3] += 6.0
-  return class_weights
+def class_weights(label_counts=None):
+  """ Per-class weights to account for the uneven distribution of classes,
+  as the {class: weight} mapping Keras expects. Each class is weighted by
+  its inverse frequency relative to the most common class. """
+  if label_counts is None:
+    label_counts = LABEL_DISTRIBUTION
+  largest = float(max(label_counts))
+  return {c: largest / count if count else 0.0 for c, count in enumerate(label_counts)}
 
 # data-loading and parsing utils
 #----------------------------------
@@ -76,6 +131,21 @@ def file_list_from_folder(folder, data_path):
       filelist.append(os.path.join(folderpath, filename))
   return filelist
 
+def load_cached_data(cache_dir, split, bands, one_hot=True):
+  """ Memory-map images and labels written by convert_data.py. The labels are
+  one-hot encoded in memory, or with one_hot=False memory-mapped class
+  indices. """
+  with open(os.path.join(cache_dir, split + "_index.json")) as f:
+    index = json.load(f)
+  if index["bands"] != list(bands):
+    raise ValueError("{} cache in {} holds bands {}, not {} (rerun convert_data.py with --bands)".format(
+      split, cache_dir, index["bands"], bands))
+  images = np.load(os.path.join(cache_dir, split + "_images.npy"), mmap_mode="r")
+  if not one_hot:
+    return images, np.load(os.path.join(cache_dir, split + "_labels.npy"), mmap_mode="r")
+  labels = np.load(os.path.join(cache_dir, split + "_labels.npy"))
+  return images, tf.keras.utils.to_categorical(labels, NUM_CLASSES)
+
 # module-loading utils
 #--------------------------------
 def load_class_from_module(module_name):
@@ -91,96 +161,668 @@ def load_optimizer(optimizer, learning_rate):
   optimizer_module = load_class_from_module(optimizer_path)
   return optimizer_module(lr=learning_rate)
 
-# data field specification for TFRecords
-features = {
-  'B1': tf.io.FixedLenFeature([], tf.string),
-  'B2': tf.io.FixedLenFeature([], tf.string),
-  'B3': tf.io.FixedLenFeature([], tf.string),
-  'B4': tf.io.FixedLenFeature([], tf.string),
-  'B5': tf.io.FixedLenFeature([], tf.string),
-  'B6': tf.io.FixedLenFeature([], tf.string),
-  'B7': tf.io.FixedLenFeature([], tf.string),
-  'B8': tf.io.FixedLenFeature([], tf.string),
-  'B9': tf.io.FixedLenFeature([], tf.string),
-  'B10': tf.io.FixedLenFeature([], tf.string),
-  'B11': tf.io.FixedLenFeature([], tf.string),
-  'label': tf.io.FixedLenFeature([], tf.int64),
-}        
-
-def parse_tfrecords(filelist, batch_size, buffer_size):
-  # try a subset of possible bands
-  def _parse_(serialized_example, keylist=['B2', 'B3', 'B4', 'B5', 'B6', 'B7', 'B8']):
+# data field specification for TFRecords: only the requested bands are
+# parsed, so unused bands are never materialized
+def feature_spec(bands):
+  spec = {band: tf.io.FixedLenFeature([], tf.string) for band in bands}
+  spec['label'] = tf.io.FixedLenFeature([], tf.int64)
+  return spec
+
+# field specification for shards written by repack_data.py: all bands in a
+# single HWC uint8 image
+def repacked_feature_spec():
+  return {
+    'image': tf.io.FixedLenFeature([], tf.string),
+    'label': tf.io.FixedLenFeature([], tf.int64),
+  }
+
+def read_shards(filelist, cycle_length, read_buffer_mb, deterministic, repeat=True, compression="",
+                offsets=None):
+  # reshuffle the shard order every epoch and read cycle_length shards in
+  # parallel, interleaving their records, so a shuffle buffer much smaller
+  # than the dataset still mixes it well and one slow read does not stall
+  # the pipeline. Non-deterministic mode takes records from whichever shard
+  # is ready first. Given the position in the shard list of the first record
+  # of every shard (offsets), yields (position, record) pairs instead.
+  filenames = tf.constant(filelist)
+  shard_dataset = tf.data.Dataset.range(len(filelist)).shuffle(len(filelist))
+  if repeat:
+    shard_dataset = shard_dataset.repeat(-1)
+
+  def _records_(shard):
+    records = tf.data.TFRecordDataset(filenames[shard], compression_type=compression,
+                                      buffer_size=read_buffer_mb * 2**20)
+    if offsets is None:
+      return records
+    first = tf.constant(offsets, dtype=tf.int64)[shard]
+    return records.apply(tf.data.experimental.enumerate_dataset()).map(lambda i, x: (first + i, x))
+
+  return shard_dataset.apply(tf.data.experimental.parallel_interleave(
+    _records_,
+    cycle_length=min(cycle_length, len(filelist)),
+    sloppy=not deterministic))
+
+def build_dataset(filelist, batch_size, buffer_size, bands=BANDS, batched_decode=BATCHED_DECODE,
+                  cycle_length=CYCLE_LENGTH, read_buffer_mb=READ_BUFFER_MB, deterministic=True,
+                  prefetch_device=None, stats_aggregator=None, cache=None, manifest=None, crop=CROP,
+                  augment=False, sample_weights=None, survey=None):
+  """ cache is None (no cache), "" (cache decoded examples in memory) or the
+  path prefix of a tf.data cache file for the decoded examples. manifest is
+  the repack_data.py manifest for shards in the repacked format. crop is the
+  side of the center crop taken while decoding (0 for the full image).
+  augment applies augment_batch to every batch. sample_weights, a weight per
+  class, adds a per-example weight to each batch. survey is
+  a (table, offsets) pair from survey_join.survey_table for filelist; the
+  table rows of every batch are gathered into a 'survey' input. """
+  crop_dim = crop_size(crop)
+  # first row/column of the center crop
+  start = (IMG_DIM - crop_dim) // 2
+  if manifest is None:
+    features = feature_spec(bands)
+    compression = ""
+  else:
+    features = repacked_feature_spec()
+    compression = "" if manifest["compression"] == "NONE" else manifest["compression"]
+    stored_bands = manifest["bands"]
+    missing = [band for band in bands if band not in stored_bands]
+    if missing:
+      raise ValueError("repacked shards do not contain bands {}".format(missing))
+    channels = [stored_bands.index(band) for band in bands]
+
+  # repacked shards hold the whole HWC image in one feature: decode it at
+  # once and pick out the requested bands
+  def _repacked_image_(raw_image, batch_shape):
+    image = tf.decode_raw(raw_image, tf.uint8)
+    image = tf.reshape(image, shape=batch_shape + [IMG_DIM, IMG_DIM, len(stored_bands)])
+    image = image[..., start:start + crop_dim, start:start + crop_dim, :]
+    if channels != list(range(len(stored_bands))):
+      image = tf.gather(image, channels, axis=-1)
+    return image
+
+  # decode the requested bands (keylist) of a single example
+  def _parse_(serialized_example, keylist=bands):
     example = tf.parse_single_example(serialized_example, features)
-   
-    def getband(example_key):
-      img = tf.decode_raw(example_key, tf.uint8)
-      return tf.reshape(img[:IMG_DIM**2], shape=(IMG_DIM, IMG_DIM, 1))
-    
-    bandlist = [getband(example[key]) for key in keylist]
-    
-    # combine bands into tensor
-    image = tf.concat(bandlist, -1)
+    if manifest is not None:
+      image = _repacked_image_(example['image'], [])
+    else:
+      def getband(example_key):
+        img = tf.decode_raw(example_key, tf.uint8)
+        band = tf.reshape(img[:IMG_DIM**2], shape=(IMG_DIM, IMG_DIM, 1))
+        # crop each band before concatenating so only the crop is copied
+        return band[start:start + crop_dim, start:start + crop_dim]
+
+      bandlist = [getband(example[key]) for key in keylist]
+
+      # combine bands into tensor
+      image = tf.concat(bandlist, -1)
     # one-hot encode ground truth labels 
     label = tf.cast(example['label'], tf.int32)
     label = tf.one_hot(label, NUM_CLASSES)
     return {'image': image}, label
-    
-  tfrecord_dataset = tf.data.TFRecordDataset(filelist)
-  tfrecord_dataset = tfrecord_dataset.map(lambda x:_parse_(x)).shuffle(buffer_size).repeat(-1).batch(batch_size)
-  tfrecord_iterator = tfrecord_dataset.make_one_shot_iterator()
-  image, label = tfrecord_iterator.get_next()
+
+  # batched variant: parse a whole batch of serialized examples at once and
+  # decode every selected band in a single decode_raw op
+  def _parse_batch_(serialized_batch, keylist=bands):
+    examples = tf.parse_example(serialized_batch, features)
+    if manifest is not None:
+      image = _repacked_image_(examples['image'], [-1])
+    else:
+      # (batch, bands) strings -> (batch, bands, raw bytes)
+      raw = tf.decode_raw(tf.stack([examples[key] for key in keylist], axis=1), tf.uint8)
+      cube = tf.reshape(raw[:, :, :IMG_DIM**2], shape=(-1, len(keylist), IMG_DIM, IMG_DIM))
+      cube = cube[:, :, start:start + crop_dim, start:start + crop_dim]
+      # channels last, same layout as the per-example path
+      image = tf.transpose(cube, perm=[0, 2, 3, 1])
+    label = tf.cast(examples['label'], tf.int32)
+    label = tf.one_hot(label, NUM_CLASSES)
+    return {'image': image}, label
+
+  # with a survey table, records carry their position in filelist, which
+  # indexes the table directly
+  def _decode_(parse):
+    if survey is None:
+      return lambda x:parse(x)
+    table = tf.constant(survey[0])
+    def _with_survey_(position, x):
+      features, label = parse(x)
+      return dict(features, survey=tf.gather(table, position)), label
+    return _with_survey_
+
+  tfrecord_dataset = read_shards(filelist, cycle_length, read_buffer_mb, deterministic,
+                                 repeat=cache is None, compression=compression,
+                                 offsets=None if survey is None else survey[1])
+  if cache is not None:
+    # decode a single pass over the shards into the cache, then shuffle and
+    # repeat the cached examples so later epochs skip parsing entirely
+    if batched_decode:
+      tfrecord_dataset = tfrecord_dataset.batch(batch_size)
+      tfrecord_dataset = tfrecord_dataset.map(_decode_(_parse_batch_),
+                                              num_parallel_calls=tf.data.experimental.AUTOTUNE)
+      tfrecord_dataset = tfrecord_dataset.apply(tf.data.experimental.unbatch())
+    else:
+      tfrecord_dataset = tfrecord_dataset.map(_decode_(_parse_))
+    tfrecord_dataset = tfrecord_dataset.cache(cache).shuffle(buffer_size).repeat(-1)
+    tfrecord_dataset = tfrecord_dataset.batch(batch_size)
+  elif batched_decode:
+    # shuffle and batch the serialized records, then decode batches in parallel
+    tfrecord_dataset = tfrecord_dataset.shuffle(buffer_size).batch(batch_size)
+    tfrecord_dataset = tfrecord_dataset.map(_decode_(_parse_batch_),
+                                            num_parallel_calls=tf.data.experimental.AUTOTUNE)
+  else:
+    tfrecord_dataset = tfrecord_dataset.map(_decode_(_parse_))
+    tfrecord_dataset = tfrecord_dataset.shuffle(buffer_size).batch(batch_size)
+  if augment:
+    tfrecord_dataset = tfrecord_dataset.map(lambda x, y:(dict(x, image=augment_batch(x['image'])), y),
+                                            num_parallel_calls=tf.data.experimental.AUTOTUNE)
+  if sample_weights is not None:
+    weights = tf.constant(sample_weights, dtype=tf.float32)
+    tfrecord_dataset = tfrecord_dataset.map(lambda x, y:(x, y, tf.gather(weights, tf.argmax(y, axis=-1))))
+  # assemble the next batches while the model trains on the current one
+  tfrecord_dataset = tfrecord_dataset.prefetch(tf.data.experimental.AUTOTUNE)
+  if stats_aggregator is not None:
+    # time spent waiting for each prefetched batch, i.e. input-bound time.
+    # With prefetch_device, this would time the staging thread's pulls
+    # rather than the model's waits (see InputBoundCallback)
+    if prefetch_device:
+      raise ValueError("input latency stats cannot be recorded after prefetch_to_device")
+    tfrecord_dataset = tfrecord_dataset.apply(tf.data.experimental.latency_stats(INPUT_WAIT_TAG))
+    options = tf.data.Options()
+    options.experimental_stats.aggregator = stats_aggregator
+    tfrecord_dataset = tfrecord_dataset.with_options(options)
+  if prefetch_device:
+    tfrecord_dataset = tfrecord_dataset.apply(tf.data.experimental.prefetch_to_device(prefetch_device))
+  return tfrecord_dataset
+
+def tfrecord_iterator(filelist, batch_size, buffer_size, **kwargs):
+  """ Iterator over build_dataset, initialized in the Keras session """
+  # a one-shot iterator cannot capture the prefetch_to_device stage
+  iterator = build_dataset(filelist, batch_size, buffer_size, **kwargs).make_initializable_iterator()
+  tf.keras.backend.get_session().run(iterator.initializer)
+  return iterator
+
+def parse_tfrecords(filelist, batch_size, buffer_size, **kwargs):
+  """ Next batch of images and labels from build_dataset, as tensors. The
+  iterator is initialized in the Keras session, so run the tensors there. """
+  image, label = tfrecord_iterator(filelist, batch_size, buffer_size, **kwargs).get_next()
   return image, label
 
+def augment_batch(images):
+  """ Apply a random flip/90 degree rotation to each image of a batch. The
+  eight symmetries of a square are every combination of a transpose, a
+  vertical flip and a horizontal flip, each chosen per image with a coin toss
+  and applied to the whole batch at once. Op seeds combined with the graph
+  seed set at the top of this file keep the sequence reproducible. """
+  batch_size = tf.shape(images)[0]
+  def coin(seed):
+    return tf.random_uniform([batch_size], seed=seed) < 0.5
+  images = tf.where(coin(1), tf.transpose(images, perm=[0, 2, 1, 3]), images)
+  images = tf.where(coin(2), tf.reverse(images, axis=[1]), images)
+  images = tf.where(coin(3), tf.reverse(images, axis=[2]), images)
+  return images
+
+def crop_size(crop):
+  """ Side of the images fed to the model for a --crop setting """
+  if crop < 0 or crop > IMG_DIM:
+    raise ValueError("crop must be between 1 and {} (or 0 for no crop), got {}".format(IMG_DIM, crop))
+  return crop or IMG_DIM
+
+def center_crop(images, crop):
+  """ Center crop a (N, IMG_DIM, IMG_DIM, bands) array. This is a view, so
+  memory-mapped arrays stay memory-mapped. """
+  crop_dim = crop_size(crop)
+  start = (IMG_DIM - crop_dim) // 2
+  return images[:, start:start + crop_dim, start:start + crop_dim, :]
+
+def decoded_example_bytes(bands, crop):
+  return crop_size(crop)**2 * len(bands) + 4 * NUM_CLASSES
+
+def shuffle_buffer_size(index, args):
+  """ Size a shuffle buffer from the memory budget: serialized records are
+  shuffled in batched-decode mode without a decode cache, decoded images
+  otherwise """
+  if args.batched_decode and args.decode_cache == "none":
+    # records of compressed repacked shards are smaller on disk than in memory
+    example_bytes = max(shard_index.mean_record_size(index), decoded_example_bytes(args.bands, args.crop))
+  else:
+    example_bytes = decoded_example_bytes(args.bands, args.crop)
+  return shard_index.shuffle_buffer_size(index, args.shuffle_memory_mb, example_bytes)
+
+def clear_stale_cache(prefix):
+  """ Remove what an interrupted run left of the tf.data cache at prefix.
+  tf.data holds a lockfile while it writes a cache and only writes the
+  .index file once the cache is complete; a run stopped before that leaves
+  the lockfile behind, and the next run would fail with "cache already in
+  use". Each cache prefix is only ever written by one process. """
+  lockfiles = glob.glob(prefix + ".lockfile") + glob.glob(prefix + "_*.lockfile")
+  if not lockfiles:
+    return
+  if os.path.exists(prefix + ".index"):
+    stale = lockfiles
+  else:
+    stale = glob.glob(prefix + ".*") + glob.glob(prefix + "_*")
+  print("removing {} file(s) of an interrupted decode cache at {}".format(len(stale), prefix))
+  for path in stale:
+    os.remove(path)
+
+def decode_cache(filelist, num_examples, args):
+  """ tf.data cache for the decoded examples of filelist: None (no cache),
+  "" (in memory) or a file in args.decode_cache_dir. The file name is keyed on
+  everything that determines the decoded examples, so a changed data path or
+  shard, band selection, feature spec or PREPROCESS_VERSION starts a fresh
+  cache. """
+  mode = args.decode_cache
+  if mode == "none":
+    return None
+  if mode == "auto":
+    decoded_mb = num_examples * decoded_example_bytes(args.bands, args.crop) / float(2**20)
+    mode = "memory" if decoded_mb <= args.decode_cache_memory_mb else "disk"
+  if mode == "memory":
+    return ""
+  key = json.dumps({
+    # a shard rewritten in place (e.g. by repack_data.py) changes size or mtime
+    "files": sorted([os.path.abspath(path), entry["size"], entry["mtime"]]
+                    for path, entry in shard_index.load_index(filelist).items()),
+    "bands": list(args.bands),
+    "crop": crop_size(args.crop),
+    "features": sorted((name, repr(spec)) for name, spec in feature_spec(args.bands).items()),
+    "format": shard_index.read_manifest(filelist),
+    "survey": [list(args.survey_columns), args.tabular, args.survey_key_feature]
+              if args.survey_columns or args.tabular else None,
+    "version": PREPROCESS_VERSION
+  }, sort_keys=True)
+  if not os.path.isdir(args.decode_cache_dir):
+    os.makedirs(args.decode_cache_dir)
+  prefix = os.path.join(args.decode_cache_dir, "decoded-" + hashlib.sha1(key.encode("utf-8")).hexdigest()[:16])
+  clear_stale_cache(prefix)
+  return prefix
+
+def survey_input(filelist, args):
+  """ build_dataset survey argument for filelist: the normalized model
+  features with --tabular, the raw --survey_columns otherwise """
+  if args.tabular:
+    if args.survey_columns:
+      raise ValueError("--tabular and --survey_columns both set the survey input")
+    return survey_join.feature_table(filelist, args.survey_key_feature)
+  if not args.survey_columns:
+    return None
+  return survey_join.survey_table(filelist, args.survey_columns, args.survey_key_feature)
+
+def pipeline_options(args):
+  """ parse_tfrecords keyword arguments from the command line settings """
+  return {
+    "bands" : args.bands,
+    "crop" : args.crop,
+    "batched_decode" : args.batched_decode,
+    "cycle_length" : args.cycle_length,
+    "read_buffer_mb" : args.read_buffer_mb,
+    "deterministic" : not args.nondeterministic,
+    "prefetch_device" : args.prefetch_device
+  }
+
 def build_regression_model(args):
   # initial regression model
   model = tf.keras.Sequential()
-  model.add(tf.keras.layers.InputLayer(input_shape=[IMG_DIM, IMG_DIM, NUM_BANDS], name='image'))
-  model.add(layers.Conv2D(filters=args.l1_size, kernel_size=(5, 5), activation='relu'))
+  model.add(tf.keras.layers.InputLayer(input_shape=[crop_size(args.crop), crop_size(args.crop), len(args.bands)],
+                                     name='image'))
+  if args.band_stats:
+    model.add(band_stats.normalization_layer(args.band_stats, args.bands))
+  model.add(CastConv2D(filters=args.l1_size, kernel_size=(5, 5), activation='relu'))
   model.add(layers.MaxPooling2D(pool_size=(2, 2)))
-  model.add(layers.Conv2D(filters=args.l2_size, kernel_size=(3, 3), activation='relu'))
+  model.add(CastConv2D(filters=args.l2_size, kernel_size=(3, 3), activation='relu'))
   model.add(layers.MaxPooling2D(pool_size=(2, 2)))
   model.add(layers.Flatten())
 
-  model.add(layers.Dense(units=args.fc1_size, activation='relu'))
-  model.add(layers.Dense(units=1, activation = 'sigmoid'))
+  model.add(CastDense(units=args.fc1_size, activation='relu'))
+  model.add(CastDense(units=1, activation = 'sigmoid'))
   model.compile(loss=tf.keras.losses.mean_squared_error, 
               optimizer=tf.keras.optimizers.Adam(), 
               metrics=['mse'])
   return model
 
-def build_classification_model(args):
+def trace_options(run_metadata):
+  """ model.compile keyword arguments that trace every step into
+  run_metadata, for InputBoundCallback """
+  return {"options": tf.RunOptions(trace_level=tf.RunOptions.SOFTWARE_TRACE), "run_metadata": run_metadata}
+
+def get_next_usecs(run_metadata, op_name):
+  """ Time in usecs the op named op_name ran in the step traced in
+  run_metadata (its longest run, as an op can show up on several device
+  streams) """
+  return max([node.all_end_rel_micros for device in run_metadata.step_stats.dev_stats
+              for node in device.node_stats if node.node_name == op_name] or [0])
+
+def cast_call(layer, call, inputs):
+  """ Run the call of a layer with float32 weights in layer.compute_dtype:
+  the inputs and, for the duration of the call, the kernel and bias are cast
+  to it, so the variables (and the optimizer slots) stay float32 and only
+  the computation runs in the lower precision """
+  kernel, bias = layer.kernel, layer.bias
+  layer.kernel = tf.cast(kernel, layer.compute_dtype)
+  layer.bias = None if bias is None else tf.cast(bias, layer.compute_dtype)
+  try:
+    return call(tf.cast(inputs, layer.compute_dtype))
+  finally:
+    layer.kernel, layer.bias = kernel, bias
+
+class CastConv2D(layers.Conv2D):
+  """ Conv2D with float32 weights computing in compute_dtype """
+  def __init__(self, compute_dtype="float32", **kwargs):
+    super(CastConv2D, self).__init__(**kwargs)
+    self.compute_dtype = compute_dtype
+
+  def call(self, inputs):
+    return cast_call(self, super(CastConv2D, self).call, inputs)
+
+  def get_config(self):
+    return dict(super(CastConv2D, self).get_config(), compute_dtype=self.compute_dtype)
+
+class CastDense(layers.Dense):
+  """ Dense with float32 weights computing in compute_dtype """
+  def __init__(self, compute_dtype="float32", **kwargs):
+    super(CastDense, self).__init__(**kwargs)
+    self.compute_dtype = compute_dtype
+
+  def call(self, inputs):
+    return cast_call(self, super(CastDense, self).call, inputs)
+
+  def get_config(self):
+    return dict(super(CastDense, self).get_config(), compute_dtype=self.compute_dtype)
+
+# saved models are loaded (predict.py, serve.py) with the cast layers known
+tf.keras.utils.get_custom_objects().update({'CastConv2D': CastConv2D, 'CastDense': CastDense})
+
+def build_classification_model(args, compile_options=None):
   # simple CNN for classifcation (default)
+  # conv/dense layers compute in args.precision with float32 weights; the
+  # softmax and the loss stay in float32. With args.tabular, the image
+  # features are joined by a dense branch over the 'survey' input before the
+  # softmax. compile_options are
+  # extra model.compile arguments (trace_options).
+  compute_dtype = args.precision
   model = tf.keras.Sequential()
-  model.add(tf.keras.layers.InputLayer(input_shape=[IMG_DIM, IMG_DIM, NUM_BANDS], name='image'))
-  model.add(layers.Conv2D(filters=args.l1_size, kernel_size=(3, 3), activation='relu'))
-  model.add(layers.MaxPooling2D(pool_size=(2, 2)))
+  model.add(tf.keras.layers.InputLayer(input_shape=[crop_size(args.crop), crop_size(args.crop), len(args.bands)],
+                                     name='image'))
+  if args.band_stats:
+    # standardize each band with the training set stats, in the compute precision
+    model.add(band_stats.normalization_layer(args.band_stats, args.bands, compute_dtype))
+  else:
+    # explicitly cast the raw uint8 pixels to the compute precision, scaled to
+    # [0, 1] in every precision
+    model.add(layers.Lambda(lambda x, dtype, scale: tf.cast(x, dtype) * scale,
+                            arguments={'dtype': compute_dtype, 'scale': 1 / 255.0}, name='cast_pixels'))
+  model.add(CastConv2D(filters=args.l1_size, kernel_size=(3, 3), activation='relu', compute_dtype=compute_dtype))
+  model.add(layers.MaxPooling2D(pool_size=(2, 2), dtype=compute_dtype))
 
-  model.add(layers.Conv2D(filters=args.l2_size, kernel_size=(3, 3), activation='relu'))
-  model.add(layers.Conv2D(filters=args.l2_size, kernel_size=(3, 3), activation='relu'))
-  model.add(layers.MaxPooling2D(pool_size=(2, 2)))
-  model.add(layers.Dropout(args.dropout_1))
+  model.add(CastConv2D(filters=args.l2_size, kernel_size=(3, 3), activation='relu', compute_dtype=compute_dtype))
+  model.add(CastConv2D(filters=args.l2_size, kernel_size=(3, 3), activation='relu', compute_dtype=compute_dtype))
+  model.add(layers.MaxPooling2D(pool_size=(2, 2), dtype=compute_dtype))
+  model.add(layers.Dropout(args.dropout_1, dtype=compute_dtype))
   
-  model.add(layers.Conv2D(filters=args.l3_size, kernel_size=(3, 3), activation='relu'))
-  model.add(layers.Conv2D(filters=args.l3_size, kernel_size=(3, 3), activation='relu'))
-  model.add(layers.MaxPooling2D(pool_size=(2, 2)))
-  model.add(layers.Dropout(rate=args.dropout_2))
-  model.add(layers.Flatten())
+  model.add(CastConv2D(filters=args.l3_size, kernel_size=(3, 3), activation='relu', compute_dtype=compute_dtype))
+  model.add(CastConv2D(filters=args.l3_size, kernel_size=(3, 3), activation='relu', compute_dtype=compute_dtype))
+  model.add(layers.MaxPooling2D(pool_size=(2, 2), dtype=compute_dtype))
+  model.add(layers.Dropout(rate=args.dropout_2, dtype=compute_dtype))
+  model.add(layers.Flatten(dtype=compute_dtype))
 
-  model.add(layers.Dense(units=args.fc1_size, activation='relu'))
-  model.add(layers.Dense(units=args.fc2_size, activation='relu'))
-  model.add(layers.Dense(NUM_CLASSES, activation='softmax'))
+  model.add(CastDense(units=args.fc1_size, activation='relu', compute_dtype=compute_dtype))
+  model.add(CastDense(units=args.fc2_size, activation='relu', compute_dtype=compute_dtype))
+  model.add(layers.Lambda(lambda x: tf.cast(x, tf.float32), name='cast_float32'))
+  if args.tabular:
+    image = tf.keras.Input(shape=model.input_shape[1:], name='image')
+    survey = tf.keras.Input(shape=(len(survey_data.TABULAR_FEATURES),), name='survey')
+    tabular = layers.Dense(units=args.tabular_size, activation='relu')(survey)
+    merged = layers.concatenate([model(image), tabular])
+    model = tf.keras.Model(inputs=[image, survey], outputs=layers.Dense(NUM_CLASSES, activation='softmax')(merged))
+  else:
+    model.add(layers.Dense(NUM_CLASSES, activation='softmax'))
   # set up optimizer
   lr_optimizer = load_optimizer(args.optimizer, args.learning_rate)
   model.compile(loss=tf.keras.losses.categorical_crossentropy,
               optimizer=lr_optimizer,
-              metrics=['accuracy'])
+              metrics=['accuracy'],
+              **(compile_options or {}))
   return model
 
+class InputBoundCallback(tf.keras.callbacks.Callback):
+  """ Logs the fraction of each epoch's training time spent waiting for
+  input batches (as input_bound_fraction), from the latency stats that
+  build_dataset records after its prefetch stage. prefetch_to_device has to
+  be the last stage of a pipeline, so with a prefetch device the waits come
+  from a trace of every training step instead (run_metadata, filled by a
+  model compiled with trace_options): the time the get_next op of the
+  training iterator ran, i.e. waited for a batch on the device. """
+  def __init__(self, stats_aggregator=None, run_metadata=None, get_next=None):
+    super(InputBoundCallback, self).__init__()
+    self.summary = None if stats_aggregator is None else stats_aggregator.get_summary()
+    self.run_metadata = run_metadata
+    self.get_next = get_next
+    self.wait_usecs = 0.0
+    self.traced_usecs = 0.0
+
+  def _total_wait_usecs(self):
+    if self.summary is None:
+      return self.traced_usecs
+    summary = tf.Summary.FromString(tf.keras.backend.get_session().run(self.summary))
+    for value in summary.value:
+      if value.tag.endswith(INPUT_WAIT_TAG) and value.HasField("histo"):
+        return value.histo.sum
+    return 0.0
+
+  def on_epoch_begin(self, epoch, logs=None):
+    self.wait_usecs = self._total_wait_usecs()
+    self.epoch_start = time.time()
+    self.train_end = self.epoch_start
+
+  def on_batch_end(self, batch, logs=None):
+    self.train_end = time.time()
+    if self.run_metadata is not None:
+      self.traced_usecs += get_next_usecs(self.run_metadata, self.get_next)
+
+  def on_epoch_end(self, epoch, logs=None):
+    # validation runs between the last training batch and the end of the
+    # epoch, and its batches come from a separate pipeline, so neither its
+    # time nor its waits are counted
+    wait_secs = (self._total_wait_usecs() - self.wait_usecs) / 1e6
+    fraction = wait_secs / max(self.train_end - self.epoch_start, 1e-6)
+    print("input-bound fraction: {:.3f}".format(fraction))
+    if logs is not None:
+      logs["input_bound_fraction"] = fraction
+
+# checkpointing utils
+#--------------------------------
+def checkpoint_path(args):
+  return os.path.join(args.checkpoint_dir, (args.model_name or "model") + ".npz")
+
+def checkpoint_steps(args):
+  # --checkpoint_steps defaults to None so --distribute can tell it was given
+  return CHECKPOINT_STEPS if args.checkpoint_steps is None else args.checkpoint_steps
+
+def write_checkpoint(path, weights, optimizer_weights, state):
+  """ Save weights, optimizer weights and the training state to a single
+  .npz file, replacing the previous checkpoint only once the new one is
+  complete """
+  arrays = {"weight_{}".format(i): w for i, w in enumerate(weights)}
+  arrays.update({"optimizer_{}".format(i): w for i, w in enumerate(optimizer_weights)})
+  arrays["state"] = np.array(json.dumps(state))
+  if not os.path.isdir(os.path.dirname(path)):
+    os.makedirs(os.path.dirname(path))
+  # np.savez appends .npz to names without it
+  partial_path = path[:-len(".npz")] + ".partial.npz"
+  np.savez(partial_path, **arrays)
+  os.replace(partial_path, path)
+
+def read_checkpoint(path):
+  """ (weights, optimizer weights, state) saved by write_checkpoint """
+  with np.load(path) as checkpoint:
+    state = json.loads(str(checkpoint["state"]))
+    weights = [checkpoint["weight_{}".format(i)] for i in range(state["num_weights"])]
+    optimizer_weights = [checkpoint["optimizer_{}".format(i)] for i in range(state["num_optimizer_weights"])]
+  return weights, optimizer_weights, state
+
+def resume_state(args):
+  """ Training state to start from: the saved one with --resume, otherwise
+  the beginning of the first epoch """
+  if not args.resume:
+    return {"epoch": 0, "step": 0, "examples": 0}
+  path = checkpoint_path(args)
+  if not os.path.exists(path):
+    raise IOError("no checkpoint to resume from at {}".format(path))
+  _, _, state = read_checkpoint(path)
+  if state["batch_size"] != args.batch_size:
+    raise ValueError("checkpoint was trained with batch size {}, not {}".format(state["batch_size"],
+                                                                               args.batch_size))
+  print("resuming from epoch {} step {}".format(state["epoch"] + 1, state["step"]))
+  return state
+
+class CheckpointCallback(tf.keras.callbacks.Callback):
+  """ Every save_steps training steps and at the end of every epoch, copies
+  the model and optimizer weights to host memory and writes them, with the
+  epoch, step and number of examples trained on, on a background thread so
+  training steps do not wait for the disk. A step checkpoint that falls due
+  while the previous one is still being written is skipped; epoch-end
+  checkpoints wait for it instead, so a completed epoch is never lost. With
+  --resume, restores the saved weights once training has built the
+  optimizer state.
+
+  With an input iterator, its position (including the shuffle and prefetch
+  buffers) is saved too, next to the checkpoint as
+  <name>.input-<epoch>-<step>, and restored with --resume, so a resumed run
+  continues with the examples the interrupted one had not reached. The
+  iterator state is saved in the training thread, as it has to match the
+  step; if a pipeline stage cannot be saved, only the weights are
+  checkpointed from then on. """
+  def __init__(self, path, save_steps, batch_size, state, restore=False, iterator=None):
+    super(CheckpointCallback, self).__init__()
+    self.path = path
+    self.save_steps = save_steps
+    self.batch_size = batch_size
+    self.resume_epoch = state["epoch"]
+    self.resume_step = state["step"]
+    self.examples = state["examples"]
+    self.input_checkpoint = state.get("input_checkpoint")
+    self.restore = restore
+    self.writer = None
+    self.input_saver = None
+    if iterator is not None:
+      # keep the input checkpoint of the previous weights checkpoint while
+      # the next one is being written
+      self.input_saver = tf.train.Saver([tf.data.experimental.make_saveable_from_iterator(iterator)],
+                                        max_to_keep=2)
+
+  def on_train_begin(self, logs=None):
+    if self.restore:
+      weights, optimizer_weights, _ = read_checkpoint(self.path)
+      self.model.set_weights(weights)
+      self.model.optimizer.set_weights(optimizer_weights)
+      if self.input_saver is not None:
+        if self.input_checkpoint:
+          self.input_saver.restore(tf.keras.backend.get_session(), self.input_checkpoint)
+        else:
+          print("no saved input position, the input restarts with a fresh pass over the training data")
+      self.restore = False
+
+  def on_epoch_begin(self, epoch, logs=None):
+    self.epoch = epoch
+    # the first epoch of a resumed run continues where the checkpoint stopped
+    self.step = self.resume_step if epoch == self.resume_epoch else 0
+
+  def on_batch_end(self, batch, logs=None):
+    self.step += 1
+    self.examples += (logs or {}).get("size", self.batch_size)
+    if self.save_steps and self.step % self.save_steps == 0:
+      self.save()
+
+  def on_epoch_end(self, epoch, logs=None):
+    self.save(wait=True)
+
+  def on_train_end(self, logs=None):
+    if self.writer is not None:
+      self.writer.join()
+
+  def save(self, wait=False):
+    if self.writer is not None and self.writer.is_alive():
+      if not wait:
+        print("previous checkpoint still being written, skipping step {}".format(self.step))
+        return
+      self.writer.join()
+    weights = self.model.get_weights()
+    optimizer_weights = self.model.optimizer.get_weights()
+    if self.input_saver is not None:
+      self.save_input()
+    state = {
+      "epoch": self.epoch,
+      "step": self.step,
+      "examples": self.examples,
+      "batch_size": self.batch_size,
+      "num_weights": len(weights),
+      "num_optimizer_weights": len(optimizer_weights),
+      "input_checkpoint": self.input_checkpoint
+    }
+    self.writer = threading.Thread(target=write_checkpoint, args=(self.path, weights, optimizer_weights, state))
+    self.writer.start()
+
+  def save_input(self):
+    name = self.path[:-len(".npz")]
+    if not os.path.isdir(os.path.dirname(name)):
+      os.makedirs(os.path.dirname(name))
+    try:
+      self.input_checkpoint = self.input_saver.save(tf.keras.backend.get_session(),
+                                                    "{}.input-{}-{}".format(name, self.epoch, self.step),
+                                                    latest_filename=os.path.basename(name) + ".input",
+                                                    write_meta_graph=False)
+    except tf.errors.OpError as e:
+      print("cannot checkpoint the input pipeline ({}), saving only the weights".format(e.message))
+      self.input_saver = None
+      self.input_checkpoint = None
+
+def resume_position(state, steps_per_epoch):
+  """ (epoch, step) to continue from after a checkpoint state; a checkpoint
+  written at the end of an epoch continues with the next one """
+  epoch, step = state["epoch"], state["step"]
+  if step >= steps_per_epoch:
+    epoch, step = epoch + 1, 0
+  return epoch, step
+
+def resume_fit(model, state, steps_per_epoch, epochs, **fit_args):
+  """ model.fit for epochs, starting from a checkpoint state: finish the
+  interrupted epoch with its remaining steps, then run the others. The
+  examples of the remaining steps come from the restored input position (see
+  CheckpointCallback), or without one from a fresh pass over the training
+  data. """
+  epoch, step = resume_position(state, steps_per_epoch)
+  if step:
+    model.fit(steps_per_epoch=steps_per_epoch - step, epochs=epoch + 1, initial_epoch=epoch, **fit_args)
+    epoch += 1
+  if epoch < epochs:
+    model.fit(steps_per_epoch=steps_per_epoch, epochs=epochs, initial_epoch=epoch, **fit_args)
+
+def save_model(model, args):
+  """ Save the trained model to --model_name (as HDF5) """
+  if args.model_name:
+    path = args.model_name if args.model_name.endswith(".h5") else args.model_name + ".h5"
+    model.save(path)
+    print("saved model to {}".format(path))
+
 def train_cnn(args):
+  if args.cache_dir:
+    return train_cnn_from_cache(args)
+  if args.distribute != "none":
+    return train_cnn_distributed(args)
+
   # load training data in TFRecord format
   train_tfrecords, val_tfrecords = load_data(args.data_path)
+  # image counts and label histograms come from the (cached) shard index
+  train_index = shard_index.load_index(train_tfrecords)
+  val_index = shard_index.load_index(val_tfrecords)
+  num_train = shard_index.num_records(train_index)
+  num_val = shard_index.num_records(val_index)
+  train_buffer = shuffle_buffer_size(train_index, args)
+  val_buffer = shuffle_buffer_size(val_index, args)
   
   # initialize wandb logging for your project and save your settings
+  # (imported here so the models and pipelines can be used without wandb)
+  import wandb
+  from wandb.keras import WandbCallback
   wandb.init(name=args.model_name)
   config={
     "batch_size" : args.batch_size,
@@ -192,27 +834,242 @@ def train_cnn(args):
     "fc2_size" : args.fc2_size,
     "dropout_1" : args.dropout_1,
     "dropout_2" : args.dropout_2,
-    "n_train" : NUM_TRAIN,
-    "n_val" : NUM_VAL,
+    "n_train" : num_train,
+    "n_val" : num_val,
     "optimizer" : args.optimizer,
-    "lr" : args.learning_rate
+    "lr" : args.learning_rate,
+    "bands" : args.bands,
+    "crop" : args.crop,
+    "augment" : args.augment,
+    "precision" : args.precision,
+    "batched_decode" : args.batched_decode,
+    "shuffle_buffer" : train_buffer,
+    "cycle_length" : args.cycle_length,
+    "nondeterministic" : args.nondeterministic,
+    "decode_cache" : args.decode_cache,
+    "survey_columns" : args.survey_columns,
+    "tabular" : args.tabular,
+    "band_stats" : args.band_stats
   }
   wandb.config.update(config)
 
-  # load images and labels from TFRecords
-  train_images, train_labels = parse_tfrecords(train_tfrecords, args.batch_size, NUM_TRAIN)
-  val_images, val_labels = parse_tfrecords(val_tfrecords, args.batch_size, NUM_VAL)
+  # load images and labels from TFRecords; a resumed run restores the position
+  # of the training iterator (see CheckpointCallback)
+  state = resume_state(args)
+  # input waits come from the pipeline's latency stats, or with a prefetch
+  # device from step traces (see InputBoundCallback)
+  input_stats = None if args.prefetch_device else tf.data.experimental.StatsAggregator()
+  train_iterator = tfrecord_iterator(train_tfrecords, args.batch_size, train_buffer,
+                                     stats_aggregator=input_stats, augment=args.augment,
+                                     cache=decode_cache(train_tfrecords, num_train, args),
+                                     manifest=shard_index.read_manifest(train_tfrecords),
+                                     survey=survey_input(train_tfrecords, args),
+                                     **pipeline_options(args))
+  train_images, train_labels = train_iterator.get_next()
+  val_images, val_labels = parse_tfrecords(val_tfrecords, args.batch_size, val_buffer,
+                                           cache=decode_cache(val_tfrecords, num_val, args),
+                                           manifest=shard_index.read_manifest(val_tfrecords),
+                                           survey=survey_input(val_tfrecords, args),
+                                           **pipeline_options(args))
   
   # number of steps per epoch is the total data size divided by the batch size
-  train_steps_per_epoch = int(math.floor(float(NUM_TRAIN) /float(args.batch_size)))
-  val_steps_per_epoch = int(math.floor(float(NUM_VAL)/float(args.batch_size)))
+  train_steps_per_epoch = int(math.floor(float(num_train) /float(args.batch_size)))
+  val_steps_per_epoch = int(math.floor(float(num_val)/float(args.batch_size)))
   
-  model = build_classification_model(args)
-  model.fit(train_images, train_labels, steps_per_epoch=train_steps_per_epoch, \
-            epochs=args.epochs, class_weight=class_weights_matrix(), \
-            validation_data=(val_images, val_labels), \
+  if args.prefetch_device:
+    run_metadata = tf.RunMetadata()
+    model = build_classification_model(args, trace_options(run_metadata))
+    input_bound = InputBoundCallback(run_metadata=run_metadata, get_next=train_labels.op.name)
+  else:
+    model = build_classification_model(args)
+    input_bound = InputBoundCallback(input_stats)
+  # the state of the prefetch_to_device stage lives on the device and cannot
+  # be saved
+  checkpoint = CheckpointCallback(checkpoint_path(args), checkpoint_steps(args), args.batch_size, state,
+                                  restore=args.resume, iterator=None if args.prefetch_device else train_iterator)
+  resume_fit(model, state, train_steps_per_epoch, args.epochs, \
+             x=train_images, y=train_labels, \
+             class_weight=class_weights(shard_index.label_counts(train_index, NUM_CLASSES)), \
+             validation_data=(val_images, val_labels), \
+             validation_steps=val_steps_per_epoch, \
+             callbacks=[checkpoint, input_bound, WandbCallback(input_type="satellite")])
+  save_model(model, args)
+
+# distributed training utils
+#--------------------------------
+def cluster_task():
+  """ (task index, number of workers) of this process in the TF_CONFIG
+  cluster, or (0, 1) when not running in a cluster """
+  tf_config = json.loads(os.environ.get("TF_CONFIG", "{}"))
+  num_workers = len(tf_config.get("cluster", {}).get("worker", []))
+  return tf_config.get("task", {}).get("index", 0), max(num_workers, 1)
+
+def shard_filelist(filelist, task_index, num_workers):
+  """ Every num_workers-th shard starting at task_index, so each worker reads
+  a disjoint part of the data """
+  shards = sorted(filelist)[task_index::num_workers]
+  if not shards:
+    raise ValueError("{} shards cannot be split over {} workers".format(len(filelist), num_workers))
+  return shards
+
+def global_replicas(strategy, num_workers):
+  """ Number of replicas over the whole cluster. num_replicas_in_sync counts
+  only this worker's replicas with tf.contrib's CollectiveAllReduceStrategy
+  (TF 1.13) until Keras configures it for the cluster, so the count is the
+  TF_CONFIG workers times this worker's devices """
+  return num_workers * len(strategy.extended.worker_devices)
+
+def distribution_strategy(mode):
+  """ tf.distribute strategy for a --distribute mode: the core API where this
+  TensorFlow version has it, tf.contrib otherwise """
+  if mode == "mirrored":
+    if hasattr(tf.distribute, "MirroredStrategy"):
+      return tf.distribute.MirroredStrategy()
+    return tf.contrib.distribute.MirroredStrategy()
+  if hasattr(tf.distribute, "experimental") and hasattr(tf.distribute.experimental, "MultiWorkerMirroredStrategy"):
+    return tf.distribute.experimental.MultiWorkerMirroredStrategy()
+  return tf.contrib.distribute.CollectiveAllReduceStrategy()
+
+def train_cnn_distributed(args):
+  # data-parallel training: every replica trains on batches of --batch_size and
+  # gradients are averaged, so the global batch and the learning rate scale
+  # with the number of replicas. In multi_worker mode (TF_CONFIG cluster, see
+  # launch_cluster.py) each worker reads a disjoint set of shards.
+  # the replicas do not checkpoint, and the input-bound callback needs the
+  # stats (or step traces) of a single pipeline
+  unsupported = [flag for flag, value in [("--checkpoint_steps", args.checkpoint_steps is not None),
+                                          ("--resume", args.resume)] if value]
+  if unsupported:
+    raise ValueError("{} not supported with --distribute".format(", ".join(unsupported)))
+  print("input_bound_fraction is not logged with --distribute")
+  task_index, num_workers = cluster_task() if args.distribute == "multi_worker" else (0, 1)
+  strategy = distribution_strategy(args.distribute)
+  num_replicas = global_replicas(strategy, num_workers)
+  global_batch_size = args.batch_size * num_replicas
+  worker_batch_size = global_batch_size // num_workers
+
+  train_tfrecords, val_tfrecords = load_data(args.data_path)
+  # index all shards so every worker agrees on the steps per epoch
+  train_index = shard_index.load_index(train_tfrecords)
+  val_index = shard_index.load_index(val_tfrecords)
+  num_train = shard_index.num_records(train_index)
+  num_val = shard_index.num_records(val_index)
+  weights = class_weights(shard_index.label_counts(train_index, NUM_CLASSES))
+  train_tfrecords = shard_filelist(train_tfrecords, task_index, num_workers)
+  val_tfrecords = shard_filelist(val_tfrecords, task_index, num_workers)
+  train_buffer = shuffle_buffer_size({path: train_index[path] for path in train_tfrecords}, args)
+  val_buffer = shuffle_buffer_size({path: val_index[path] for path in val_tfrecords}, args)
+
+  import wandb
+  from wandb.keras import WandbCallback
+  wandb.init(name=args.model_name)
+  config={
+    "batch_size" : args.batch_size,
+    "global_batch_size" : global_batch_size,
+    "epochs": args.epochs,
+    "l1_size" : args.l1_size,
+    "l2_size" : args.l2_size,
+    "l3_size" : args.l3_size,
+    "fc1_size" : args.fc1_size,
+    "fc2_size" : args.fc2_size,
+    "dropout_1" : args.dropout_1,
+    "dropout_2" : args.dropout_2,
+    "n_train" : num_train,
+    "n_val" : num_val,
+    "optimizer" : args.optimizer,
+    "lr" : args.learning_rate * num_replicas,
+    "bands" : args.bands,
+    "crop" : args.crop,
+    "augment" : args.augment,
+    "precision" : args.precision,
+    "distribute" : args.distribute,
+    "num_workers" : num_workers,
+    "num_replicas" : num_replicas
+  }
+  wandb.config.update(config)
+
+  # Keras does not take class_weight together with a distribution strategy,
+  # so the pipeline emits per-example weights instead
+  sample_weights = [weights[c] for c in range(NUM_CLASSES)]
+  train_dataset = build_dataset(train_tfrecords, worker_batch_size, train_buffer, augment=args.augment,
+                                cache=decode_cache(train_tfrecords, num_train // num_workers, args),
+                                manifest=shard_index.read_manifest(train_tfrecords),
+                                survey=survey_input(train_tfrecords, args),
+                                sample_weights=sample_weights, **pipeline_options(args))
+  val_dataset = build_dataset(val_tfrecords, worker_batch_size, val_buffer,
+                              cache=decode_cache(val_tfrecords, num_val // num_workers, args),
+                              manifest=shard_index.read_manifest(val_tfrecords),
+                              survey=survey_input(val_tfrecords, args),
+                              **pipeline_options(args))
+
+  train_steps_per_epoch = int(math.floor(float(num_train) / float(global_batch_size)))
+  val_steps_per_epoch = int(math.floor(float(num_val) / float(global_batch_size)))
+
+  model_args = argparse.Namespace(**vars(args))
+  model_args.learning_rate = args.learning_rate * num_replicas
+  with strategy.scope():
+    model = build_classification_model(model_args)
+  model.fit(train_dataset, steps_per_epoch=train_steps_per_epoch, \
+            epochs=args.epochs, \
+            validation_data=val_dataset, \
             validation_steps=val_steps_per_epoch, \
             callbacks=[WandbCallback(input_type="satellite")])
+  if task_index == 0:
+    save_model(model, args)
+
+def train_cnn_from_cache(args):
+  # the cached arrays hold only images and labels, and Keras feeds them as is
+  unsupported = [flag for flag, value in [("--augment", args.augment), ("--survey_columns", args.survey_columns),
+                                          ("--tabular", args.tabular)] if value]
+  if unsupported:
+    raise ValueError("{} need the TFRecord pipeline, not --cache_dir".format(", ".join(unsupported)))
+  # load memory-mapped images and labels written by convert_data.py
+  train_images, train_labels = load_cached_data(args.cache_dir, "train", args.bands)
+  val_images, val_labels = load_cached_data(args.cache_dir, "val", args.bands)
+  train_images = center_crop(train_images, args.crop)
+  val_images = center_crop(val_images, args.crop)
+
+  import wandb
+  from wandb.keras import WandbCallback
+  wandb.init(name=args.model_name)
+  config={
+    "batch_size" : args.batch_size,
+    "epochs": args.epochs,
+    "l1_size" : args.l1_size,
+    "l2_size" : args.l2_size,
+    "l3_size" : args.l3_size,
+    "fc1_size" : args.fc1_size,
+    "fc2_size" : args.fc2_size,
+    "dropout_1" : args.dropout_1,
+    "dropout_2" : args.dropout_2,
+    "n_train" : len(train_images),
+    "n_val" : len(val_images),
+    "optimizer" : args.optimizer,
+    "lr" : args.learning_rate,
+    "bands" : args.bands,
+    "crop" : args.crop,
+    "precision" : args.precision,
+    "cache_dir" : args.cache_dir
+  }
+  wandb.config.update(config)
+
+  model = build_classification_model(args)
+  # Keras shuffles the arrays itself, so a resumed run restarts the
+  # interrupted epoch from its first step
+  train_steps_per_epoch = int(math.ceil(float(len(train_images)) / float(args.batch_size)))
+  state = resume_state(args)
+  epoch, _ = resume_position(state, train_steps_per_epoch)
+  state = dict(state, epoch=epoch, step=0)
+  checkpoint = CheckpointCallback(checkpoint_path(args), checkpoint_steps(args), args.batch_size, state,
+                                  restore=args.resume)
+  # shuffle whole batches rather than single rows so each batch is a
+  # contiguous read from the memory-mapped array
+  model.fit({'image': train_images}, train_labels, batch_size=args.batch_size, \
+            epochs=args.epochs, initial_epoch=state["epoch"], shuffle="batch", \
+            class_weight=class_weights(train_labels.sum(axis=0)), \
+            validation_data=({'image': val_images}, val_labels), \
+            callbacks=[checkpoint, WandbCallback(input_type="satellite")])
+  save_model(model, args)
  
 if __name__ == "__main__":
   parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -228,6 +1085,12 @@ if __name__ == "__main__":
     type=str,
     default=DATA_PATH,
     help="Path to data, containing train/ and val/")
+  parser.add_argument(
+    "-c",
+    "--cache_dir",
+    type=str,
+    default=CACHE_DIR,
+    help="Train from memory-mapped arrays written by convert_data.py instead of TFRecords")
   parser.add_argument(
     "-b",
     "--batch_size",
@@ -287,6 +1150,115 @@ if __name__ == "__main__":
     type=float,
     default=LEARNING_RATE,
     help="Learning rate")
+  parser.add_argument(
+    "--bands",
+    nargs="+",
+    choices=ALL_BANDS,
+    default=BANDS,
+    help="Spectral bands to load (sets the number of model input channels)")
+  parser.add_argument(
+    "--crop",
+    type=int,
+    default=CROP,
+    help="Train on a center crop of this size (0 keeps the full image)")
+  parser.add_argument(
+    "--augment",
+    action="store_true",
+    default=AUGMENT,
+    help="Randomly flip and rotate training batches by multiples of 90 degrees")
+  parser.add_argument(
+    "--survey_columns",
+    nargs="+",
+    default=SURVEY_COLUMNS,
+    help="extra_data.csv columns to attach to every batch as the 'survey' input (see survey_join.py)")
+  parser.add_argument(
+    "--survey_key_feature",
+    type=str,
+    default=SURVEY_KEY_FEATURE,
+    help="Bytes feature of the TFRecord examples holding the survey uuid")
+  parser.add_argument(
+    "--tabular",
+    action="store_true",
+    help="Add a branch over the normalized survey features (altitude, accuracy, water_points, month)")
+  parser.add_argument(
+    "--tabular_size",
+    type=int,
+    default=TABULAR_SIZE,
+    help="Size of the dense layer of the survey feature branch")
+  parser.add_argument(
+    "--band_stats",
+    type=str,
+    default=BAND_STATS,
+    help="Stats file from band_stats.py to standardize each band with inside the model")
+  parser.add_argument(
+    "--batched_decode",
+    action="store_true",
+    default=BATCHED_DECODE,
+    help="Parse and decode TFRecords in parallel batches instead of per example")
+  parser.add_argument(
+    "--cycle_length",
+    type=int,
+    default=CYCLE_LENGTH,
+    help="Number of shards read in parallel")
+  parser.add_argument(
+    "--read_buffer_mb",
+    type=int,
+    default=READ_BUFFER_MB,
+    help="Read buffer size in MB for each shard")
+  parser.add_argument(
+    "--nondeterministic",
+    action="store_true",
+    help="Take records from whichever shard is ready first (faster, order not reproducible)")
+  parser.add_argument(
+    "--prefetch_device",
+    type=str,
+    default=PREFETCH_DEVICE,
+    help="Device to prefetch input batches to, e.g. /gpu:0 (default: host memory only)")
+  parser.add_argument(
+    "--decode_cache",
+    choices=["none", "memory", "disk", "auto"],
+    default=DECODE_CACHE,
+    help="Cache decoded examples after the first epoch (auto: in memory if they fit, else on disk)")
+  parser.add_argument(
+    "--decode_cache_dir",
+    type=str,
+    default=DECODE_CACHE_DIR,
+    help="Directory for on-disk decode caches")
+  parser.add_argument(
+    "--decode_cache_memory_mb",
+    type=int,
+    default=DECODE_CACHE_MEMORY_MB,
+    help="Largest decoded dataset size in MB that --decode_cache auto keeps in memory")
+  parser.add_argument(
+    "--shuffle_memory_mb",
+    type=int,
+    default=SHUFFLE_MEMORY_MB,
+    help="Memory budget in MB for each shuffle buffer")
+  parser.add_argument(
+    "--distribute",
+    choices=["none", "mirrored", "multi_worker"],
+    default=DISTRIBUTE,
+    help="Data-parallel training over local devices or over the TF_CONFIG cluster (see launch_cluster.py)")
+  parser.add_argument(
+    "--precision",
+    choices=["float32", "bfloat16"],
+    default=PRECISION,
+    help="Compute precision of the CNN layers (weights, softmax and loss stay in float32)")
+  parser.add_argument(
+    "--checkpoint_dir",
+    type=str,
+    default=CHECKPOINT_DIR,
+    help="Directory for training checkpoints, saved as <model_name>.npz")
+  parser.add_argument(
+    "--checkpoint_steps",
+    type=int,
+    default=None,
+    help="Training steps between checkpoints (0 for end of epoch only; default {})".format(CHECKPOINT_STEPS))
+  parser.add_argument(
+    "--resume",
+    action="store_true",
+    help="Restore the last checkpoint (weights, optimizer state and, without --prefetch_device, "
+         "the training input position) and continue training after its last completed step")
   parser.add_argument(
     "-q",
     "--dry_run",